@@ -1,14 +1,23 @@
 from contextlib import ExitStack
 from datetime import datetime, timezone
 from importlib import import_module
+import json
 import os
 import traceback
 
 from pladder.dbus import PLADDER_BOT_XML
 from pladder.plugin import BotPluginInterface, PluginLoadError
 from pladder.plugins.builtin import command_usage
-from pladder.script.interpreter import interpret
-from pladder.script.types import ScriptError, ApplyError, CommandRegistry, new_context
+from pladder.script.cost import check_cost
+from pladder.script.interpreter import compile, interpret
+from pladder.script.types import ScriptError, ApplyError, BoundedTrace, Budget, BudgetLimits, CommandRegistry, \
+    new_context
+
+
+# Only the last few command applications of each level (and only a few
+# levels deep) are kept for trace-last and last-output
+TRACE_MAX_ENTRIES = 16
+TRACE_MAX_DEPTH = 3
 
 
 def main():
@@ -37,6 +46,7 @@ class PladderBot(ExitStack, BotPluginInterface):
         self.bus = bus
         self.commands = CommandRegistry()
         self.last_contexts = {}
+        self.default_limits, self.network_limits = read_budget_config(os.path.join(state_dir, "budget.json"))
 
     def new_command_group(self, name):
         return self.commands.new_command_group(name)
@@ -48,7 +58,11 @@ class PladderBot(ExitStack, BotPluginInterface):
                     'nick': nick,
                     'text': text}
         try:
-            context = new_context(self.commands, metadata=metadata)
+            limits = self.network_limits.get(network, self.default_limits)
+            context = new_context(self.commands, metadata=metadata, budget=Budget(limits),
+                                  trace=BoundedTrace(TRACE_MAX_ENTRIES, TRACE_MAX_DEPTH))
+            # Scripts that are sure to exceed the budget are refused up front
+            check_cost(compile(text), self.commands, limits)
             result_text = interpret(context, text)
             result_text = result_text[:10000]
             result = {'text': result_text,
@@ -70,6 +84,19 @@ class PladderBot(ExitStack, BotPluginInterface):
         return result
 
 
+def read_budget_config(config_path):
+    try:
+        with open(config_path, "rt") as f:
+            config_data = json.load(f)
+    except FileNotFoundError:
+        config_data = {}
+    networks = config_data.pop("networks", {})
+    default_limits = BudgetLimits(**config_data)
+    network_limits = {network: default_limits._replace(**limits)
+                      for network, limits in networks.items()}
+    return default_limits, network_limits
+
+
 def load_standard_plugins(bot):
     plugins = [
         "builtin",
@@ -6,8 +6,9 @@ from typing import List, Optional, Tuple
 
 from pladder.plugin import BotPluginInterface, Plugin
 from pladder.script.parser import escape
-from pladder.script.interpreter import interpret
-from pladder.script.types import CommandBinding, CommandGroup, CommandRegistry, Context, \
+from pladder.script.interpreter import interpret, preload_script
+from pladder.script.serialize import deserialize_call, serialize_script
+from pladder.script.types import CommandBinding, CommandGroup, CommandRegistry, Context, ParseError, \
     command_binding
 
 
@@ -30,6 +31,17 @@ class DBError(Exception):
     pass
 
 
+def alias_script(template: str) -> str:
+    return "echo " + template
+
+
+def compile_template(template: str) -> str:
+    try:
+        return serialize_script(alias_script(template))
+    except ParseError as e:
+        raise ParseError(f"Invalid alias: {e}")
+
+
 class AliasCommands(CommandGroup):
     def __init__(self,
                  alias_db: "AliasDb",
@@ -49,19 +61,24 @@ class AliasCommands(CommandGroup):
     # CommandGroup methods
 
     def lookup_command(self, command_name: str) -> Optional[CommandBinding]:
-        row = self.alias_db.get_alias(command_name)
+        row = self.alias_db.get_compiled_alias(command_name)
         if not row:
             return None
-        _name, template = row
+        template, ast = row
+        script = alias_script(template)
+        if ast is not None:
+            preload_script(script, lambda: deserialize_call(ast))
         source = f"add-alias {escape(command_name)} {escape(template)}"
 
-        def exec_command(context: Context) -> str:
-            script = "echo " + template
+        def body(context: Context) -> Tuple[Context, str]:
             subcontext = context._replace(environment={})
-            return interpret(subcontext, script)
+            return subcontext, script
+
+        def exec_command(context: Context) -> str:
+            return interpret(*body(context))
 
         return command_binding(command_name, exec_command,
-                               contextual=True, source=source)
+                               contextual=True, source=source, body=body)
 
     def list_commands(self) -> List[str]:
         return self.alias_db.list_alias("")
@@ -87,6 +104,7 @@ class AliasCommands(CommandGroup):
         if self.binding_exists(name):
             return "Hallå farfar, den finns ju redan."
         self.alias_db.add_alias(name, data)
+        self.all_cmds.commands_changed()
         return f"\"{name}\" added. value is: \"{data}\""
 
     def get_alias(self, name: str) -> str:
@@ -101,8 +119,11 @@ class AliasCommands(CommandGroup):
         if not row:
             return "Hallå farfar, den där finns ju inte ens."
         old = row[1]
+        # Fail before the old alias is deleted if the new one is invalid
+        compile_template(data)
         self.alias_db.del_alias(name)
         self.alias_db.add_alias(name, data)
+        self.all_cmds.commands_changed()
         return f"\"{name}\" updated. value is: \"{data}\", was: \"{old}\""
 
     def del_alias(self, name: str) -> str:
@@ -111,6 +132,7 @@ class AliasCommands(CommandGroup):
                 self.alias_db.del_alias(name)
             except Exception:
                 return "Det blir inget med det."
+            self.all_cmds.commands_changed()
             return "Alias removed"
         else:
             return errorstr()
@@ -137,6 +159,7 @@ class AliasDb(ExitStack):
         c = self._db.cursor()
         if not self._check_db_exists(c):
             self._initdb(c)
+        self._migrate(c)
 
     def _check_db_exists(self, c: sqlite3.dbapi2.Cursor) -> bool:
         try:
@@ -167,6 +190,28 @@ class AliasDb(ExitStack):
 
         self._db.commit()
 
+    def _migrate(self, c: sqlite3.dbapi2.Cursor) -> None:
+        c.execute("SELECT value FROM config WHERE key='version'")
+        version = int(c.fetchone()[0])
+        if version < 2:
+            c.execute("BEGIN TRANSACTION")
+            try:
+                c.execute("ALTER TABLE alias ADD COLUMN ast TEXT")
+                c.execute("SELECT name, data FROM alias")
+                for name, data in c.fetchall():
+                    try:
+                        ast = compile_template(data)
+                    except ParseError:
+                        # Left as it is, and fails when it is run
+                        continue
+                    c.execute("UPDATE alias SET ast=? WHERE name=?", (ast, name))
+                c.execute("UPDATE config SET value='2' WHERE key='version'")
+            except Exception:
+                self._db.rollback()
+                raise
+            else:
+                self._db.commit()
+
     def _alias_exists(self, name: str) -> bool:
         c = self._db.cursor()
         c.execute("SELECT * FROM alias WHERE name=?", [name])
@@ -176,10 +221,11 @@ class AliasDb(ExitStack):
             return False
 
     def _insert_alias(self, name: str, data: str) -> None:
+        ast = compile_template(data)
         c = self._db.cursor()
         c.execute("BEGIN TRANSACTION")
         try:
-            c.execute("INSERT INTO alias (name, data) VALUES (?, ?)", (name, data))
+            c.execute("INSERT INTO alias (name, data, ast) VALUES (?, ?, ?)", (name, data, ast))
         except Exception:
             self._db.rollback()
             raise DBError("You cannot insert ye value :(")
@@ -204,6 +250,17 @@ class AliasDb(ExitStack):
         else:
             return None
 
+    def get_compiled_alias(self, name: str) -> Optional[Tuple[str, Optional[str]]]:
+        # The template of the alias and its serialized script
+        c = self._db.cursor()
+        try:
+            c.execute("SELECT data, ast FROM alias WHERE name=?", [name])
+        except Exception:
+            raise DBError("eror :(")
+        else:
+            row = c.fetchone()
+            return (row[0], row[1]) if row else None
+
     def del_alias(self, name: str) -> None:
         if self._alias_exists(name):
             c = self._db.cursor()
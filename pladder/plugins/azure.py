@@ -61,9 +61,9 @@ class AzureCommands:
             'toScript': "Latn"
         }
 
-        cmds.register_command("translatify-list", self.print_language_list)
-        cmds.register_command("translatify", self.translatify, varargs=True)
-        cmds.register_command("translatify-native", self.translatify_native, varargs=True)
+        cmds.register_command("translatify-list", self.print_language_list, concurrent=True)
+        cmds.register_command("translatify", self.translatify, varargs=True, concurrent=True)
+        cmds.register_command("translatify-native", self.translatify_native, varargs=True, concurrent=True)
 
     def print_language_list(self):
         """
@@ -85,11 +85,12 @@ class AzureCommands:
         """
         if len(language) > 20 or len(text) > 2000:
             raise PluginError("Translation sanity check failed")
-        # Generate new uuid for each request
-        self.headers['X-ClientTraceId'] = str(uuid.uuid4())
-        self.params['to'] = language
+        # Generate new uuid for each request. The headers and parameters are
+        # copied, since translations may run concurrently.
+        headers = dict(self.headers, **{'X-ClientTraceId': str(uuid.uuid4())})
+        params = dict(self.params, to=language)
         body = [{'text': text}]
-        request = requests.post(self.config.endpoint, params=self.params, headers=self.headers, json=body)
+        request = requests.post(self.config.endpoint, params=params, headers=headers, json=body)
         response = request.json()
         if "error" in response:
             raise PluginError(response.get("error").get("message"))
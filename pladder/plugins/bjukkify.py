@@ -4,7 +4,7 @@ from contextlib import contextmanager
 @contextmanager
 def pladder_plugin(bot):
     cmds = bot.new_command_group("bjukkify")
-    cmds.register_command("bjukkify", bjukkify, varargs=True)
+    cmds.register_command("bjukkify", bjukkify, varargs=True, pure=True, memoize=True)
     yield
 
 
@@ -1,12 +1,14 @@
 from contextlib import contextmanager
-from inspect import Parameter, signature
+from inspect import Parameter
 import os
 import random
 
 import pladder.irc.color as color
 from pladder.script.parser import escape
-from pladder.script.interpreter import apply_call, interpret
-from pladder.script.types import ScriptError, new_context
+from pladder.script.interpreter import apply_call, interpret, run_script
+from pladder.script.memo import memo
+from pladder.script.types import Profile, Scope, ScriptError, new_context
+from pladder.script.values import list_items, make_list
 
 
 def _pairs(iterable):
@@ -34,29 +36,47 @@ def pladder_plugin(bot):
 
     cmds = bot.new_command_group("builtin")
     # Strings
-    cmds.register_command("echo", lambda text="": text, varargs=True)
-    cmds.register_command("concat", lambda *args: " ".join(arg.strip() for arg in args))
-    cmds.register_command("escape", lambda text="": escape(text), varargs=True)
+    cmds.register_command("echo", lambda text="": text, varargs=True, pure=True)
+    cmds.register_command("concat", lambda *args: " ".join(arg.strip() for arg in args), pure=True)
+    cmds.register_command("escape", lambda text="": escape(text), varargs=True, pure=True)
     # Booleans
-    cmds.register_command("=", eq)
-    cmds.register_command("/=", ne)
-    cmds.register_command("bool", bool_command)
-    cmds.register_command("if", if_command)
+    cmds.register_command("=", eq, pure=True)
+    cmds.register_command("/=", ne, pure=True)
+    cmds.register_command("bool", bool_command, pure=True)
+    # Conditionals are lazy: only the arguments that are needed are evaluated.
+    # They are hybrid (as are the commands that run scripts below), so the
+    # arguments are evaluated asynchronously under interpret_async.
+    cmds.register_command("if", if_command, pure=True, lazy=True, hybrid=True, cost=if_cost)
+    cmds.register_command("when", when, pure=True, lazy=True, hybrid=True, cost=when_cost)
+    cmds.register_command("cond", cond, pure=True, lazy=True, hybrid=True, cost=cond_cost)
+    cmds.register_command("and", and_command, pure=True, lazy=True, hybrid=True)
+    cmds.register_command("or", or_command, pure=True, lazy=True, hybrid=True)
     # Integers
-    cmds.register_command("format-int", format_int)
+    cmds.register_command("format-int", format_int, pure=True)
     cmds.register_command("random-range", random_range)
     # Arguments
-    cmds.register_command("first", first)
-    cmds.register_command("last", last)
-    cmds.register_command("nth", nth)
+    cmds.register_command("first", first, pure=True)
+    cmds.register_command("last", last, pure=True)
+    cmds.register_command("nth", nth, pure=True)
     cmds.register_command("pick", lambda *args: random.choice(args) if args else "")
     cmds.register_command("wpick", wpick)
+
+    cmds.register_command("split", split, pure=True)
+    cmds.register_command("join", join, pure=True)
+    cmds.register_command("length", length, pure=True)
+    cmds.register_command("slice", slice_command, pure=True)
+    # Not pure: constant folding would make long ranges without a budget
+    cmds.register_command("range", range_command)
+    cmds.register_command("map", map_command, contextual=True, hybrid=True, cost=map_cost)
+    cmds.register_command("filter", filter_command, contextual=True, hybrid=True, cost=map_cost)
+    cmds.register_command("fold", fold, contextual=True, hybrid=True, cost=fold_cost)
     # Intertwined with interpreter
-    cmds.register_command("eval", eval_command, contextual=True)
-    cmds.register_command("eval-pick", eval_pick, contextual=True)
+    cmds.register_command("eval", eval_command, contextual=True, hybrid=True, cost=eval_cost)
+    cmds.register_command("eval-pick", eval_pick, contextual=True, hybrid=True, cost=eval_pick_cost)
     cmds.register_command("comp", comp, contextual=True)
-    cmds.register_command("repeat", repeat, contextual=True)
-    cmds.register_command("let", let, contextual=True)
+    cmds.register_command("apply", apply_command, contextual=True)
+    cmds.register_command("repeat", repeat, contextual=True, hybrid=True, cost=repeat_cost)
+    cmds.register_command("let", let, contextual=True, hybrid=True, cost=let_cost)
     # Documentation
     cmds.register_command("version", lambda: version)
     cmds.register_command("help", help, contextual=True)
@@ -64,8 +84,10 @@ def pladder_plugin(bot):
     # Debuggning
     cmds.register_command("show-args", lambda *args: repr(args))
     cmds.register_command("show-context", show_context, contextual=True)
-    cmds.register_command("trace", trace, contextual=True)
+    cmds.register_command("trace", trace, contextual=True, cost=trace_cost)
+    cmds.register_command("profile", profile, contextual=True, cost=eval_cost)
     cmds.register_command("trace-last", lambda context, mode: trace_last(context, mode, last_contexts), contextual=True)
+    cmds.register_command("memo-stats", memo_stats)
     # Last command
     cmds.register_command("last-output", lambda context: last_output(context, last_contexts), contextual=True)
     yield
@@ -83,11 +105,74 @@ def bool_command(value):
     return _bool_py_to_pladder(_bool_pladder_to_py(value))
 
 
-def if_command(condition, then_value, else_value):
-    if _bool_pladder_to_py(condition):
-        return then_value
+async def if_command(condition, then_value, else_value):
+    if _bool_pladder_to_py(await condition):
+        return await then_value
+    else:
+        return await else_value
+
+
+async def when(condition, value):
+    if _bool_pladder_to_py(await condition):
+        return await value
     else:
-        return else_value
+        return ""
+
+
+async def cond(*clauses):
+    # cond <condition> <value> <condition> <value> ... [default]
+    for condition, value in _pairs(clauses[:len(clauses) // 2 * 2]):
+        if _bool_pladder_to_py(await condition):
+            return await value
+    if len(clauses) % 2 == 1:
+        return await clauses[-1]
+    return ""
+
+
+async def and_command(*conditions):
+    for condition in conditions:
+        if not _bool_pladder_to_py(await condition):
+            return "false"
+    return "true"
+
+
+async def or_command(*conditions):
+    for condition in conditions:
+        if _bool_pladder_to_py(await condition):
+            return "true"
+    return "false"
+
+
+# Cost functions of the conditionals get an ArgumentCost for each argument
+# word (see pladder.script.types.CostFunction). Only one branch is taken,
+# and it is known which one if the condition is a literal.
+
+def if_cost(condition, then_value, else_value):
+    if condition.literal == "true":
+        return condition.cost + then_value.cost
+    elif condition.literal == "false":
+        return condition.cost + else_value.cost
+    return condition.cost + max(then_value.cost, else_value.cost)
+
+
+def when_cost(condition, value):
+    if condition.literal == "false":
+        return condition.cost
+    return condition.cost + value.cost
+
+
+def cond_cost(*clauses):
+    cost = 0
+    values = []
+    for condition, value in _pairs(clauses[:len(clauses) // 2 * 2]):
+        cost += condition.cost
+        if condition.literal == "true":
+            return cost + max(values + [value.cost])
+        elif condition.literal != "false":
+            values.append(value.cost)
+    if len(clauses) % 2 == 1:
+        values.append(clauses[-1].cost)
+    return cost + max(values, default=0)
 
 
 def _bool_py_to_pladder(b):
@@ -139,13 +224,141 @@ def wpick(*args):
     return random.choices(values, weights, k=1)[0]
 
 
-def eval_command(context, script):
-    return interpret(context, script)
+# Lists (see pladder.script.values) are made and read without quoting and
+# parsing them again when they are passed from one of these to another.
+
+MAX_RANGE_LENGTH = 100000
+
+
+def split(text, separator=None):
+    if separator is None:
+        return make_list(item for item in text.split(" ") if item)
+    if not separator:
+        raise ScriptError("split: empty separator")
+    return make_list(text.split(separator))
+
+
+def join(items, separator=" "):
+    return separator.join(list_items(items))
 
 
-def eval_pick(context, *args):
+def length(items):
+    return str(len(list_items(items)))
+
+
+def slice_command(items, start, end=None):
+    start = _number("slice", start)
+    end = None if end is None else _number("slice", end)
+    return make_list(list_items(items)[start:end])
+
+
+def range_command(*args):
+    if not 1 <= len(args) <= 3:
+        raise ScriptError("range: expected 1 to 3 numbers")
+    bounds = [_number("range", arg) for arg in args]
+    if len(bounds) == 3 and bounds[2] == 0:
+        raise ScriptError("range: step must not be zero")
+    numbers = range(*bounds)
+    if len(numbers) > MAX_RANGE_LENGTH:
+        raise ScriptError(f"range: more than {MAX_RANGE_LENGTH} numbers")
+    return make_list(map(str, numbers))
+
+
+def _number(command_name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ScriptError(f"{command_name}: expected a number, got {value}")
+
+
+async def map_command(context, name, items, script):
+    return make_list(result for _item, result in await _for_each(context, name, items, script))
+
+
+async def filter_command(context, name, items, script):
+    results = await _for_each(context, name, items, script)
+    return make_list(item for item, result in results if _bool_pladder_to_py(result))
+
+
+async def _for_each(context, name, items, script):
+    # Runs the script for each item, with the item bound to name
+    budget = context.budget
+    results = []
+    length = 0
+    for item in list_items(items):
+        if budget is not None:
+            budget.charge()
+        result = await run_script(context._replace(environment=Scope({name: item}, context.environment)), script)
+        if budget is not None:
+            length += len(result) + 1
+            budget.check_length(length)
+        results.append((item, result))
+    return results
+
+
+async def fold(context, accumulator_name, item_name, initial, items, script):
+    budget = context.budget
+    accumulator = initial
+    for item in list_items(items):
+        if budget is not None:
+            budget.charge()
+        bindings = {accumulator_name: accumulator, item_name: item}
+        accumulator = await run_script(context._replace(environment=Scope(bindings, context.environment)), script)
+        if budget is not None:
+            budget.check_string(accumulator)
+    return accumulator
+
+
+def apply_command(context, command_name, *args):
+    # The items of the list (the last argument) are the last arguments of
+    # the command, e.g. `apply pick $list` or `apply nth 2 $list`
+    if not args:
+        raise ScriptError("apply: no list given")
+    return _apply(context, [command_name, *args[:-1], *list_items(args[-1])])
+
+
+# Cost functions (see pladder.script.cost) of the commands that run scripts
+
+def eval_cost(estimate, script):
+    return estimate(script)
+
+
+def eval_pick_cost(estimate, *scripts):
+    return max((estimate(script) for script in scripts), default=0)
+
+
+def repeat_cost(estimate, count, script, delimiter=None):
+    if count is None:
+        return estimate(script)
+    # Each round is charged to the budget, as well as the script
+    return max(int(count), 0) * (1 + estimate(script))
+
+
+def let_cost(estimate, *args):
+    return estimate(args[-1]) if args else 0
+
+
+def map_cost(estimate, name, items, script):
+    if items is None:
+        return estimate(script)
+    return len(list_items(items)) * (1 + estimate(script))
+
+
+def fold_cost(estimate, accumulator_name, item_name, initial, items, script):
+    return map_cost(estimate, item_name, items, script)
+
+
+def trace_cost(estimate, mode, script):
+    return estimate(script)
+
+
+async def eval_command(context, script):
+    return await run_script(context, script)
+
+
+async def eval_pick(context, *args):
     script = random.choice(args) if args else ""
-    return interpret(context, script)
+    return await run_script(context, script)
 
 
 def comp(context, command1, *command2_words):
@@ -164,19 +377,27 @@ def _apply(context, words):
     return apply_call(command_context, command, command_name, arguments)
 
 
-def repeat(context, count, script, delimiter="   "):
-    texts = [interpret(context, script) for _ in range(int(count))]
+async def repeat(context, count, script, delimiter="   "):
+    budget = context.budget
+    texts = []
+    length = 0
+    for _ in range(int(count)):
+        if budget is not None:
+            budget.charge()
+        text = await run_script(context, script)
+        texts.append(text)
+        if budget is not None:
+            length += len(text) + len(delimiter)
+            budget.check_length(length)
     return delimiter.join(texts)
 
 
-def let(context, *args):
+async def let(context, *args):
     if len(args) % 2 != 1:
         raise ScriptError("Let accepts an odd number of arguments (name-value pairs and a body)")
-    new_env = dict(context.environment)
-    for variable, value in _pairs(args[:-1]):
-        new_env[variable] = value
-    subcontext = context._replace(environment=new_env)
-    return interpret(subcontext, args[-1])
+    bindings = dict(_pairs(args[:-1]))
+    subcontext = context._replace(environment=Scope(bindings, context.environment))
+    return await run_script(subcontext, args[-1])
 
 
 def help(context, type=None, name=None):
@@ -223,7 +444,7 @@ def help(context, type=None, name=None):
 
 def command_usage(command):
     result = command.display_name
-    parameters = list(signature(command.fn).parameters.values())
+    parameters = list(command.arity.parameters)
     if command.contextual:
         # pop context argument
         parameters.pop(0)
@@ -253,7 +474,7 @@ def show_context(context):
 
 
 def trace(context, mode, script):
-    subcontext = new_context(context.commands, metadata=context.metadata)
+    subcontext = new_context(context.commands, metadata=context.metadata, budget=context.budget)
     try:
         interpret(subcontext, script)
     except Exception:
@@ -261,11 +482,42 @@ def trace(context, mode, script):
     return render_trace(subcontext.trace, mode)
 
 
+def profile(context, script):
+    subprofile = Profile()
+    start = subprofile.clock()
+    try:
+        interpret(context._replace(profile=subprofile), script)
+        failure = ""
+    except ScriptError as e:
+        failure = f" (failed: {e})"
+    elapsed = subprofile.clock() - start
+    return render_profile(subprofile, elapsed) + failure
+
+
+def render_profile(profile, elapsed_ns, max_entries=8):
+    by_self_time = sorted(profile.entries.items(), key=lambda item: item[1].self_ns, reverse=True)
+    parts = [f"{name} {entry.calls}x {_format_ns(entry.self_ns)} self/{_format_ns(entry.total_ns)} total"
+             for name, entry in by_self_time[:max_entries]]
+    result = f"Profile: {_format_ns(elapsed_ns)}"
+    if parts:
+        result += ". " + ", ".join(parts)
+    if len(by_self_time) > max_entries:
+        result += f" (and {len(by_self_time) - max_entries} more)"
+    return result
+
+
+def _format_ns(ns):
+    return f"{ns / 1e6:.2f} ms"
+
+
 def trace_last(context, mode, last_contexts):
     last_context = last_contexts.get((context.metadata["network"], context.metadata["channel"]), None)
     if not last_context or not last_context.trace:
         return "No last trace stored"
-    return render_trace(last_context.trace, mode)
+    rendered = render_trace(last_context.trace, mode)
+    if last_context.trace.truncated:
+        rendered = "(Only the last part of the trace was kept) " + rendered
+    return rendered
 
 
 def render_trace(trace, mode):
@@ -331,8 +583,11 @@ def full_trace(trace, color_pairs):
         dark = color.RESET
     parts = []
     for entry in trace:
-        words = [entry.command_name] + entry.arguments
-        call = " ".join(map(escape, words))
+        if entry.command.lazy:
+            # The arguments of lazy commands are traced as unevaluated source
+            call = " ".join([escape(entry.command_name)] + entry.arguments)
+        else:
+            call = " ".join(map(escape, [entry.command_name] + entry.arguments))
         result = escape(entry.result)
         if entry.subtrace:
             sub = full_trace(entry.subtrace, color_pairs)
@@ -343,6 +598,23 @@ def full_trace(trace, color_pairs):
     return f"{dark}, ".join(parts) + color.RESET
 
 
+def memo_stats(command_name=None):
+    command_stats = memo.command_stats()
+    if command_name is not None:
+        if command_name not in command_stats:
+            return f"No memoized calls to {command_name}"
+        stats = command_stats[command_name]
+        return f"{command_name}: {stats.hits} hits, {stats.misses} misses ({stats.hit_rate:.0%} hit rate)"
+    cache_stats = memo.cache_stats()
+    result = (f"Memo: {cache_stats.size // 1024} of {cache_stats.max_size // 1024} kB used, "
+              f"{cache_stats.evictions} evictions")
+    by_calls = sorted(command_stats.items(), key=lambda item: item[1].calls, reverse=True)
+    parts = [f"{name} {stats.hits}/{stats.calls} ({stats.hit_rate:.0%})" for name, stats in by_calls[:10]]
+    if parts:
+        result += ". Hits: " + ", ".join(parts)
+    return result
+
+
 def last_output(context, last_contexts):
     last_context = last_contexts.get((context.metadata["network"], context.metadata["channel"]), None)
     if not last_context or not last_context.trace:
@@ -10,20 +10,20 @@ from pladder.script.types import ScriptError
 @contextmanager
 def pladder_plugin(bot):
     cmds = bot.new_command_group("misc")
-    cmds.register_command("give", give, varargs=True)
-    cmds.register_command(re.compile("^kloo+fify$"), kloooofify, varargs=True, contextual=True)
-    cmds.register_command(re.compile("^vrå*lify$"), vraaaal, varargs=True, contextual=True)
+    cmds.register_command("give", give, varargs=True, pure=True)
+    cmds.register_command(re.compile("^kloo+fify$"), kloooofify, varargs=True, contextual=True, pure=True, memoize=True)
+    cmds.register_command(re.compile("^vrå*lify$"), vraaaal, varargs=True, contextual=True, pure=True, memoize=True)
     cmds.register_command("time", time)
-    cmds.register_command("capify", capify, varargs=True)
+    cmds.register_command("capify", capify, varargs=True, pure=True, memoize=True)
     cmds.register_command("suspektify", suspektify, varargs=True)
-    cmds.register_command("tutify", tutify, varargs=True)
-    cmds.register_command("unicode", unicode, varargs=True)
-    cmds.register_command("unicode-name", unicode_name, varargs=True)
+    cmds.register_command("tutify", tutify, varargs=True, pure=True)
+    cmds.register_command("unicode", unicode, varargs=True, pure=True)
+    cmds.register_command("unicode-name", unicode_name, varargs=True, pure=True, memoize=True)
     cmds.register_command("tijd", tijd)
     cmds.register_command("vecka", vecka)
     cmds.register_command("morse", morse, varargs=True)
-    cmds.register_command("unmorse", unmorse)
-    cmds.register_command("reverse", reverse, varargs=True)
+    cmds.register_command("unmorse", unmorse, pure=True, memoize=True)
+    cmds.register_command("reverse", reverse, varargs=True, pure=True)
     yield
 
 
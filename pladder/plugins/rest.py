@@ -1,4 +1,6 @@
+import asyncio
 from contextlib import contextmanager
+from functools import partial
 
 from pladder.script.types import ScriptError
 
@@ -8,16 +10,21 @@ import requests  # type: ignore
 @contextmanager
 def pladder_plugin(bot):
     cmds = bot.new_command_group("rest")
+    # Not concurrent: a POST has side effects, and must not be sent when an
+    # earlier argument fails
     cmds.register_command("rest-post-simple", rest_post_simple)
     yield
 
 
-def rest_post_simple(url, message):
+async def rest_post_simple(url, message):
     """
     Do a POST to a simple REST API, sending plain text and returning the result
     """
     headers = {"Content-Type": "text/plain; charset=utf-8"}
-    r = requests.post(url, headers=headers, data=message.encode("utf-8"))
+    # The request is made in a worker thread, so that other scripts evaluated
+    # by interpret_async can run while it waits
+    post = partial(requests.post, url, headers=headers, data=message.encode("utf-8"))
+    r = await asyncio.get_running_loop().run_in_executor(None, post)
     if r.status_code != 200:
         raise ScriptError("Unexpected error code: %d" % r.status_code)
     else:
@@ -1,8 +1,12 @@
-from pytest import fixture
+import sqlite3
+
+from pytest import fixture, raises
 
 from .alias import AliasDb, AliasCommands
 from pladder.script.interpreter import interpret
-from pladder.script.types import CommandRegistry, new_context
+from pladder.script.parser import parse
+from pladder.script.serialize import deserialize_call
+from pladder.script.types import CommandRegistry, ParseError, new_context
 
 
 @fixture(scope="function")
@@ -121,3 +125,45 @@ def test_invalid_add_other_group(alias_cmds):
 def test_set_alias(populated_alias_cmds):
     result = populated_alias_cmds.set_alias("testalias", "hest")
     assert result == "\"testalias\" updated. value is: \"hest\", was: \"testtest\""
+
+
+def test_exec_updated_alias(commands, populated_alias_cmds):
+    context = new_context(commands)
+    assert interpret(context, "testalias") == "testtest"
+    populated_alias_cmds.set_alias("testalias", "hest")
+    assert interpret(context, "testalias") == "hest"
+
+
+def test_invalid_template_is_rejected(alias_cmds):
+    with raises(ParseError, match="Invalid alias"):
+        alias_cmds.add_alias("broken", "[echo")
+    assert alias_cmds.alias_db.get_alias("broken") is None
+
+
+def test_set_invalid_template_keeps_old(populated_alias_cmds):
+    with raises(ParseError):
+        populated_alias_cmds.set_alias("testalias", "}")
+    assert populated_alias_cmds.get_alias("testalias") == "testtest"
+
+
+def test_db_stores_compiled_template(populated_alias_db):
+    template, ast = populated_alias_db.get_compiled_alias("testalias")
+    assert template == "testtest"
+    assert deserialize_call(ast) == parse("echo testtest")
+
+
+def test_db_migrates_version_1(tmp_path):
+    path = str(tmp_path / "alias.db")
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE config (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, value TEXT);
+        INSERT INTO config(id, key, value) VALUES ('1', 'version', '1');
+        CREATE TABLE alias (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, data TEXT);
+        INSERT INTO alias(name, data) VALUES ('hello', 'Hej [echo $x]'), ('broken', '[');
+    """)
+    db.close()
+    with AliasDb(path) as alias_db:
+        assert deserialize_call(alias_db.get_compiled_alias("hello")[1]) == parse("echo Hej [echo $x]")
+        assert alias_db.get_compiled_alias("broken") == ("[", None)
+    with AliasDb(path) as alias_db:
+        assert alias_db.get_alias("hello") == ("hello", "Hej [echo $x]")
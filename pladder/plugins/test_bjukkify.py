@@ -14,7 +14,7 @@ def test_registers_command():
     with pladder_plugin(bot):
         pass
     bot.new_command_group.assert_called_with("bjukkify")
-    cmds.register_command.assert_called_with("bjukkify", bjukkify, varargs=True)
+    cmds.register_command.assert_called_with("bjukkify", bjukkify, varargs=True, pure=True, memoize=True)
 
 
 examples = {
@@ -0,0 +1,328 @@
+import asyncio
+import re
+
+from pytest import fixture, raises
+
+from .builtin import pladder_plugin
+from pladder.script import values, vm
+from pladder.script.cost import check_cost, estimate_applications
+from pladder.script.interpreter import eval_call, interpret, interpret_async
+from pladder.script.parser import parse
+from pladder.script.types import BoundedTrace, Budget, BudgetExceeded, BudgetLimits, CommandRegistry, ScriptError, \
+    new_context
+
+
+METADATA = {"network": "net", "channel": "#chan", "nick": "nick"}
+
+
+class DummyBot:
+    def __init__(self):
+        self.state_dir = "/nonexistent"
+        self.commands = CommandRegistry()
+        self.last_contexts = {}
+
+    def new_command_group(self, name):
+        return self.commands.new_command_group(name)
+
+
+@fixture
+def bot():
+    bot = DummyBot()
+    with pladder_plugin(bot):
+        yield bot
+
+
+@fixture
+def commands(bot):
+    return bot.commands
+
+
+def run(commands, script, **limits):
+    context = new_context(commands, budget=Budget(BudgetLimits(**limits)))
+    return interpret(context, script)
+
+
+def test_repeat(commands):
+    assert run(commands, "repeat 3 {echo a} ,") == "a,a,a"
+
+
+def test_repeat_stops_at_max_applications(commands):
+    with raises(BudgetExceeded, match="100 command applications"):
+        run(commands, "repeat 1000000 {}", max_applications=100)
+
+
+def test_repeat_stops_at_max_string_length(commands):
+    with raises(BudgetExceeded, match="longer than 50 characters"):
+        run(commands, "repeat 1000000 {echo aaaaaaaaaa}", max_string_length=50)
+
+
+def test_nested_repeat_stops_at_max_seconds(commands):
+    with raises(BudgetExceeded, match="running for 0.0 seconds"):
+        run(commands, "repeat 1000 {repeat 1000 {echo a}}", max_seconds=0.0)
+
+
+def test_trace_uses_same_budget(commands):
+    context = new_context(commands, budget=Budget(BudgetLimits(max_applications=100)))
+    assert "repeat" in interpret(context, "trace -brief {repeat 1000000 {}}")
+    assert context.budget.applications == 101
+
+
+def run_last(bot, script, trace):
+    context = new_context(bot.commands, metadata=METADATA, trace=trace)
+    interpret(context, script)
+    bot.last_contexts[("net", "#chan")] = context
+
+
+def test_trace_last_full(bot):
+    run_last(bot, "echo [echo a]", None)
+    result = interpret(new_context(bot.commands, metadata=METADATA), "trace-last -brief")
+    assert "echo" in result
+    assert "Only the last part" not in result
+
+
+def test_trace_last_bounded(bot):
+    run_last(bot, "eval {eval {echo a}}", BoundedTrace(max_entries=10, max_depth=2))
+    result = interpret(new_context(bot.commands, metadata=METADATA), "trace-last -brief")
+    assert result.startswith("(Only the last part of the trace was kept) ")
+
+
+def test_last_output_with_bounded_trace(bot):
+    run_last(bot, "repeat 100 {echo a} {}", BoundedTrace(max_entries=2, max_depth=1))
+    assert interpret(new_context(bot.commands, metadata=METADATA), "last-output") == "a" * 100
+
+
+def test_memo_stats(commands):
+    result = run(commands, "memo-stats")
+    assert result.startswith("Memo: ")
+
+
+def test_if_only_evaluates_taken_branch(commands):
+    assert run(commands, "if [= a a] yes [no-such-command]") == "yes"
+    assert run(commands, "if [= a b] [no-such-command] no") == "no"
+    with raises(ScriptError, match="Unknown command name"):
+        run(commands, "if [= a b] yes [no-such-command]")
+
+
+def test_when(commands):
+    assert run(commands, "when [= a a] [echo yes]") == "yes"
+    assert run(commands, "when [= a b] [no-such-command]") == ""
+
+
+def test_cond(commands):
+    script = "cond [= $x a] {was a} [= $x b] {was b} [echo default]"
+    assert run_with_x(commands, script, "a") == "was a"
+    assert run_with_x(commands, script, "b") == "was b"
+    assert run_with_x(commands, script, "c") == "default"
+    assert run(commands, "cond false [no-such-command]") == ""
+    assert run(commands, "cond true yes [no-such-command] no") == "yes"
+
+
+def run_with_x(commands, script, x):
+    return interpret(new_context(commands, environment={"x": x}), script)
+
+
+def test_and_or_short_circuit(commands):
+    assert run(commands, "and [= a a] [= b b]") == "true"
+    assert run(commands, "and [= a b] [no-such-command]") == "false"
+    assert run(commands, "or [= a b] [= b b]") == "true"
+    assert run(commands, "or [= a a] [no-such-command]") == "true"
+    assert run(commands, "and") == "true"
+    assert run(commands, "or") == "false"
+
+
+def test_lazy_arguments_in_full_trace(commands):
+    rendered = strip_colors(run(commands, "trace -full {if [pick true] [pick {yes sir}] $unbound}"))
+    assert rendered == "[if [pick true] [pick {yes sir}] $unbound] => ( [pick true] => true, " \
+        "[pick {yes sir}] => {yes sir} ) => {yes sir}"
+
+
+def strip_colors(text):
+    return re.sub("\x03[0-9]*(,[0-9]+)?|\x0f", "", text)
+
+
+def test_nested_let(commands):
+    assert run(commands, "let x 1 y 2 {let x 3 {echo $x $y}}") == "3 2"
+
+
+def test_deep_let(commands):
+    script = "echo $x " + " ".join(f"$v{i}" for i in range(20))
+    for i in range(20):
+        script = f"let x {i} v{i} {i} {{{script}}}"
+    assert run(commands, script) == "0 " + " ".join(str(i) for i in range(20))
+
+
+def test_profile(commands):
+    rendered = run(commands, "profile {repeat 3 {pick [pick a]}}")
+    assert re.match(r"Profile: [0-9.]+ ms\. ", rendered)
+    assert re.search(r"pick 6x [0-9.]+ ms self/[0-9.]+ ms total", rendered)
+    assert re.search(r"repeat 1x [0-9.]+ ms self/[0-9.]+ ms total", rendered)
+
+
+def test_profile_of_failing_script(commands):
+    assert run(commands, "profile {pick [no-such-command]}").endswith("(failed: Unknown command name: no-such-command)")
+
+
+def test_cost_of_scripts_run_by_builtins(commands):
+    assert estimate_applications(parse("repeat 1000 {repeat 1000 {echo a}}"), commands) == 1 + 1000 * (1 + 1 + 1000 * 2)
+    assert estimate_applications(parse("let x 1 {eval {echo $x}}"), commands) == 3
+    assert estimate_applications(parse("trace -brief {repeat 5 {echo}}"), commands) == 1 + 1 + 5 * 2
+
+
+def test_split_and_join(commands):
+    assert run(commands, "split {a  b c}") == "a b c"
+    assert run(commands, "split a,b,,c ,") == "a b {} c"
+    assert run(commands, "join {a {b c} {}} -") == "a-b c-"
+    assert run(commands, "join [split {x y}]") == "x y"
+    with raises(ScriptError, match="empty separator"):
+        run(commands, "split abc {}")
+
+
+def test_length_and_slice(commands):
+    assert run(commands, "length {a {b c} {}}") == "3"
+    assert run(commands, "length {}") == "0"
+    assert run(commands, "slice {a {b c} d e} 1 3") == "{b c} d"
+    assert run(commands, "slice {a b c d} -2") == "c d"
+    with raises(ScriptError, match="slice: expected a number, got x"):
+        run(commands, "slice {a b c} x")
+    with raises(ScriptError, match="slice: expected a number, got y"):
+        run(commands, "slice {a b c} 0 y")
+
+
+def test_split_text_with_braces(commands):
+    context = new_context(commands, environment={"t": "hej :{ hopp }:"})
+    assert interpret(context, "length [split $t]") == "4"
+    assert interpret(context, "join [slice [split $t] 1 2]") == ":{"
+    assert interpret(context, "length [echo [split $t]]") == "4"
+    assert interpret(context, "map w [split $t] {echo <$w}") == "<hej <:\\{ <hopp <\\}:"
+
+
+def test_list_of_text_with_backslashes(commands):
+    assert run(commands, "join {\\o/ hi} -") == "\\o/-hi"
+    assert run(commands, "join {C:\\dir x} ,") == "C:\\dir,x"
+    assert run(commands, "map w {\\o/ yay} {echo $w}") == run(commands, "map w [split {\\o/ yay}] {echo $w}")
+
+
+def test_unbalanced_list(commands):
+    context = new_context(commands, environment={"l": "a {b"})
+    with raises(ScriptError, match="Missing closing brace"):
+        interpret(context, "length $l")
+
+
+def test_range(commands):
+    assert run(commands, "range 4") == "0 1 2 3"
+    assert run(commands, "range 2 8 3") == "2 5"
+    with raises(ScriptError, match="more than 100000 numbers"):
+        run(commands, "range 1000000")
+    with raises(ScriptError, match="expected 1 to 3 numbers"):
+        run(commands, "range")
+    with raises(ScriptError, match="step must not be zero"):
+        run(commands, "range 1 10 0")
+    with raises(ScriptError, match="range: expected a number, got a"):
+        run(commands, "range a")
+
+
+def test_map_filter_fold(commands):
+    assert run(commands, "map w {a {b c}} {echo <$w}") == "<a {<b c}"
+    assert run(commands, "filter n [range 6] {= $n 3}") == "3"
+    assert run(commands, "fold acc w {} {a b c} {echo $w$acc}") == "cba"
+    assert run(commands, "let w outer {echo [map w {a} {echo $w}] $w}") == "a outer"
+
+
+def test_map_stops_at_max_applications(commands):
+    with raises(BudgetExceeded, match="100 command applications"):
+        run(commands, "map n [range 100000] {echo $n}", max_applications=100)
+
+
+def test_cost_of_list_commands(commands):
+    assert estimate_applications(parse("map w {a b c} {echo $w}"), commands) == 1 + 3 * 2
+    assert estimate_applications(parse("fold a w {} {a b} {echo $w}"), commands) == 1 + 2 * 2
+    assert estimate_applications(parse("filter n [range 5] {echo $n}"), commands) == 2 + 1
+
+
+def test_apply(commands):
+    assert run(commands, "apply nth 1 [split {x y z}]") == "y"
+    assert run(commands, "apply echo {a {b c}}") == "a b c"
+    with raises(ScriptError, match="no list given"):
+        run(commands, "apply echo")
+
+
+def test_lists_are_passed_without_parsing(commands, monkeypatch):
+    def parse_list(text):
+        raise AssertionError(f"Parsed {text}")
+    monkeypatch.setattr(values, "parse_list", parse_list)
+    script = "let l [range 5] {length [filter n [map n $l {echo $n}] {if [= $n 2] false true}]}"
+    assert run(commands, script) == "4"
+    assert eval_call(new_context(commands), parse(script)) == "4"
+    assert vm.run(new_context(commands), script) == "4"
+
+
+def test_lists_are_strings(commands):
+    assert run(commands, "echo [split {a  b}]!") == "a b!"
+    assert run(commands, "= [range 3] {0 1 2}") == "true"
+
+
+def test_cost_of_conditionals_counts_one_branch(commands):
+    expensive = "[repeat 1000 {echo a}]"
+    expensive_cost = 1 + 1000 * 2
+    assert estimate_applications(parse(f"if false {expensive} ok"), commands) == 1
+    assert estimate_applications(parse(f"if true {expensive} ok"), commands) == 1 + expensive_cost
+    assert estimate_applications(parse(f"if [= a b] ok {expensive}"), commands) == 1 + 1 + expensive_cost
+    assert estimate_applications(parse(f"when [= a b] {expensive}"), commands) == 1 + 1 + expensive_cost
+    assert estimate_applications(parse(f"cond [= a b] {expensive} [= a a] [echo] ok"), commands) == \
+        1 + 2 + expensive_cost
+    assert estimate_applications(parse(f"cond [= a b] [echo] true {expensive} {expensive}"), commands) == \
+        1 + 1 + expensive_cost
+    assert estimate_applications(parse(f"and {expensive} {expensive}"), commands) == 1 + 2 * expensive_cost
+
+
+def test_expensive_untaken_branch_is_not_refused(commands):
+    limits = BudgetLimits(max_applications=3000)
+    check_cost(parse("if false [repeat 100000 {echo a}] ok"), commands, limits)
+    check_cost(parse("if true ok [repeat 100000 {echo a}]"), commands, limits)
+    check_cost(parse("when false [repeat 100000 {echo a}]"), commands, limits)
+    check_cost(parse("cond false [repeat 100000 {echo a}] true ok [repeat 100000 {echo b}]"), commands, limits)
+    # Unknown conditions count the most expensive branch
+    check_cost(parse("if [= a b] [repeat 1000 {echo a}] [repeat 1000 {echo b}]"), commands, limits)
+    with raises(BudgetExceeded, match="estimated"):
+        check_cost(parse("if [= a b] [repeat 100000 {echo a}] ok"), commands, limits)
+    assert run(commands, "if false [repeat 100000 {echo a}] ok", max_applications=10) == "ok"
+
+
+def test_range_is_not_folded_without_budget(commands):
+    with raises(BudgetExceeded, match="longer than 100 characters"):
+        run(commands, "length [range 100000]", max_string_length=100)
+
+
+def add_signals(commands):
+    events = {}
+
+    async def signal(name):
+        events.setdefault(name, asyncio.Event()).set()
+        return name
+
+    async def wait_for(name):
+        await events.setdefault(name, asyncio.Event()).wait()
+        return name
+
+    group = commands.new_command_group("signals")
+    group.register_command("signal", signal)
+    group.register_command("wait-for", wait_for)
+
+
+def test_scripts_and_lazy_arguments_are_awaited_under_interpret_async(commands):
+    add_signals(commands)
+    scripts = [
+        ("if [= a a] [wait-for if] x", "if"),
+        ("when true [eval {wait-for eval}]", "eval"),
+        ("repeat 2 {wait-for repeat} ,", "repeat,repeat"),
+        ("let x let {wait-for $x}", "let"),
+        ("map w {map fold} {wait-for $w}", "map fold"),
+        ("echo [signal if] [signal eval] [signal repeat] [signal let] [signal map] [fold a w {} fold {signal $w}]",
+         "if eval repeat let map fold"),
+    ]
+
+    async def run_all():
+        return await asyncio.wait_for(asyncio.gather(*[
+            interpret_async(new_context(commands), script) for script, _result in scripts]), timeout=5)
+
+    assert asyncio.run(run_all()) == [result for _script, result in scripts]
@@ -0,0 +1,70 @@
+import sqlite3
+
+from pytest import fixture, raises
+
+from .userdef import UserdefCommands, UserdefDb
+from pladder.script.interpreter import interpret
+from pladder.script.parser import parse
+from pladder.script.serialize import deserialize_call
+from pladder.script.types import CommandRegistry, ParseError, new_context
+
+
+@fixture
+def userdef_db():
+    with UserdefDb(":memory:") as db:
+        yield db
+
+
+@fixture
+def commands(userdef_db):
+    cmds = CommandRegistry()
+    builtin = cmds.new_command_group("builtin")
+    builtin.register_command("echo", lambda text="": text, varargs=True)
+    UserdefCommands(userdef_db, cmds)
+    return cmds
+
+
+def run(commands, script):
+    return interpret(new_context(commands), script)
+
+
+def test_def_command(commands):
+    assert run(commands, "def-command greet who {echo Hej $who}") == "Command added: greet who => echo Hej $who"
+    assert run(commands, "greet världen") == "Hej världen"
+
+
+def test_def_command_rejects_invalid_script(commands, userdef_db):
+    with raises(ParseError, match="Invalid script: Missing closing bracket"):
+        run(commands, "def-command broken {} {echo [oops}")
+    assert userdef_db.lookup_command("broken") is None
+
+
+def test_set_command_with_invalid_script_keeps_old(commands):
+    run(commands, "def-command greet {} {echo hej}")
+    with raises(ParseError):
+        run(commands, "set-command greet {} {echo ]}")
+    assert run(commands, "greet") == "hej"
+
+
+def test_db_stores_compiled_script(userdef_db):
+    userdef_db.add_command("greet", ["who"], "echo Hej $who!")
+    command = userdef_db.lookup_command("greet")
+    assert deserialize_call(command.ast) == parse("echo Hej $who!")
+
+
+def test_db_migrates_version_2(tmp_path):
+    path = str(tmp_path / "userdef.db")
+    db = sqlite3.connect(path)
+    db.executescript("""
+        CREATE TABLE meta (key TEXT UNIQUE, value TEXT);
+        INSERT INTO meta(key, value) VALUES ('version', '2');
+        CREATE TABLE commands (name TEXT UNIQUE, params TEXT, script TEXT);
+        CREATE TABLE cells (name TEXT UNIQUE, value TEXT);
+        INSERT INTO commands(name, params, script) VALUES ('greet', 'who', 'echo Hej $who!'), ('broken', '', '[');
+    """)
+    db.close()
+    with UserdefDb(path) as userdef_db:
+        assert deserialize_call(userdef_db.lookup_command("greet").ast) == parse("echo Hej $who!")
+        assert userdef_db.lookup_command("broken").ast is None
+    with UserdefDb(path) as userdef_db:
+        assert userdef_db.lookup_command("greet").params == ["who"]
@@ -1,18 +1,23 @@
 from contextlib import ExitStack, contextmanager
 import os
 import sqlite3
-from typing import Iterator, List, NamedTuple, Optional
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 
 from pladder.plugin import BotPluginInterface, Plugin
 from pladder.script.parser import escape
-from pladder.script.interpreter import interpret
-from pladder.script.types import CommandBinding, CommandGroup, CommandRegistry, Context, ScriptError, command_binding
+from pladder.script.interpreter import interpret, preload_script
+from pladder.script.serialize import deserialize_call, serialize_script
+from pladder.script.types import CommandBinding, CommandGroup, CommandRegistry, Context, ParseError, ScriptError, \
+    command_binding
 
 
 class Command(NamedTuple):
     name: str
     params: List[str]
     script: str
+    # The parsed script, serialized. None if the script could not be parsed
+    # when the database was migrated.
+    ast: Optional[str] = None
 
 
 class Cell(NamedTuple):
@@ -53,9 +58,12 @@ class UserdefCommands(CommandGroup):
         if maybe_command is None:
             return None
         command = maybe_command
+        ast = command.ast
+        if ast is not None:
+            preload_script(command.script, lambda: deserialize_call(ast))
         source = f"def-command {escape(command.name)} {escape(' '.join(command.params))} {escape(command.script)}"
 
-        def exec_command(context: Context, *args: str) -> str:
+        def body(context: Context, *args: str) -> Tuple[Context, str]:
             if len(command.params) != len(args):
                 # special case when the command expects 1 argument: just append the arguments together
                 if len(command.params) == 1 and len(args) > 1:
@@ -64,10 +72,13 @@ class UserdefCommands(CommandGroup):
                     raise ScriptError(f"{command.name} takes {len(command.params)} arguments, got {len(args)}")
             new_env = dict(zip(command.params, args))
             subcontext = context._replace(environment=new_env)
-            return interpret(subcontext, command.script)
+            return subcontext, command.script
+
+        def exec_command(context: Context, *args: str) -> str:
+            return interpret(*body(context, *args))
 
         return command_binding(command_name, exec_command,
-                               contextual=True, source=source)
+                               contextual=True, source=source, body=body)
 
     def list_commands(self) -> List[str]:
         return self.userdef_db.list_commands()
@@ -92,6 +103,7 @@ class UserdefCommands(CommandGroup):
         else:
             params_list = []
         self.userdef_db.add_command(name, params_list, script)
+        self.all_cmds.commands_changed()
         return "Command added: " + self._prettify_command(name, params_list, script)
 
     def set_command(self, name: str, params: str, script: str) -> str:
@@ -102,8 +114,11 @@ class UserdefCommands(CommandGroup):
             params_list = params.split(" ")
         else:
             params_list = []
+        # Fail before the old command is deleted if the new script is invalid
+        compile_script(script)
         self.userdef_db.del_command(name)
         self.userdef_db.add_command(name, params_list, script)
+        self.all_cmds.commands_changed()
         return ("Command updated. Now: " + self._prettify_command(name, params_list, script) +
                 " Was: " + self._prettify_command(command.name, command.params, command.script))
 
@@ -112,6 +127,7 @@ class UserdefCommands(CommandGroup):
         if command is None:
             return f'A command with name "{name}" doesn\'t exists!'
         self.userdef_db.del_command(name)
+        self.all_cmds.commands_changed()
         return "Command deleted. Was: " + self._prettify_command(command.name, command.params, command.script)
 
     # Cells
@@ -153,6 +169,13 @@ class UserdefCommands(CommandGroup):
         return "Cells: " + ", ".join(sorted(cells))
 
 
+def compile_script(script: str) -> str:
+    try:
+        return serialize_script(script)
+    except ParseError as e:
+        raise ParseError(f"Invalid script: {e}")
+
+
 class UserdefDb(ExitStack):
     def __init__(self, db_file_path: str) -> None:
         super().__init__()
@@ -202,24 +225,42 @@ class UserdefDb(ExitStack):
                     SET value = '2'
                     WHERE key = 'version';
                 """)
+            if version < 3:
+                c.execute("""
+                    ALTER TABLE commands
+                    ADD COLUMN ast TEXT;
+                """)
+                c.execute("SELECT name, script FROM commands;")
+                for name, script in c.fetchall():
+                    try:
+                        ast = serialize_script(script)
+                    except ParseError:
+                        # Left as it is, and fails when it is run
+                        continue
+                    c.execute("UPDATE commands SET ast = ? WHERE name = ?;", (ast, name))
+                c.execute("""
+                    UPDATE meta
+                    SET value = '3'
+                    WHERE key = 'version';
+                """)
 
     # Commands
 
     def lookup_command(self, name: str) -> Optional[Command]:
         with self._transaction() as c:
             c.execute("""
-                SELECT name, params, script
+                SELECT name, params, script, ast
                 FROM commands
                 WHERE name = ?;
             """, (name,))
             row = c.fetchone()
             if row:
-                name, params_string, script = row
+                name, params_string, script, ast = row
                 if params_string:
                     params = params_string.split(" ")
                 else:
                     params = []
-                return Command(name, params, script)
+                return Command(name, params, script, ast)
             else:
                 return None
 
@@ -228,11 +269,12 @@ class UserdefDb(ExitStack):
             if " " in param or "{" in param or "}" in param:
                 raise ScriptError(f'Invalid parameter name: "{param}"')
         params_string = " ".join(params)
+        ast = compile_script(script)
         with self._transaction() as c:
             c.execute("""
-                INSERT INTO commands(name, params, script)
-                VALUES (?, ?, ?);
-            """, (name, params_string, script))
+                INSERT INTO commands(name, params, script, ast)
+                VALUES (?, ?, ?, ?);
+            """, (name, params_string, script, ast))
 
     def del_command(self, name: str) -> None:
         with self._transaction() as c:
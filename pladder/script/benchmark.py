@@ -0,0 +1,477 @@
+"""Micro-benchmarks for the PladderScript interpreter.
+
+Run all benchmarks with `python -m pladder.script.benchmark`, or give
+benchmark names as arguments to only run some of them. Each benchmark
+reports operations per second and the peak memory allocated during one
+operation. Save the results with `--json results.json` and compare a
+later run against them with `--compare results.json`.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import re
+import sys
+import time
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .interpreter import apply_call, compile_call, eval_call, interpret, interpret_async
+from .parser import parse
+from .types import Call, CommandRegistry, Context, Node, NoTrace, PythonCommandGroup, command_binding, new_context
+from .vm import compile_program, run_program
+
+
+Operation = Callable[[], object]
+Setup = Callable[[], Operation]
+
+BENCHMARKS: Dict[str, Setup] = {}
+
+
+def benchmark(name: str) -> Callable[[Setup], Setup]:
+    def register(setup: Setup) -> Setup:
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@benchmark("parse-short")
+def parse_short() -> Operation:
+    return lambda: parse(NESTED_SCRIPT)
+
+
+@benchmark("parse-long")
+def parse_long() -> Operation:
+    # Long alias definitions with a lot of quoted text are the common case
+    script = "add-alias long " + " ".join([f"{{{ALIAS_TEMPLATE}}} [echo $x {{{USERDEF_SCRIPT}}}]"] * 40)
+    return lambda: parse(script)
+
+
+def _registry() -> CommandRegistry:
+    group = PythonCommandGroup()
+    group.register_command("echo", lambda text="": text, varargs=True)
+    group.register_command("concat", lambda *args: " ".join(arg.strip() for arg in args))
+    group.register_command("upper", lambda s: s.upper())
+    group.register_command("reverse", lambda s: s[::-1])
+    group.register_command("cat3", lambda x, y, z: x + y + z)
+    return CommandRegistry({"bench": group})
+
+
+@benchmark("apply")
+def apply() -> Operation:
+    commands = _registry()
+    context = new_context(commands)
+    command = command_binding("cat3", lambda x, y, z: x + y + z)
+    arguments = ["one", "two", "three"]
+    return lambda: apply_call(context, command, "cat3", arguments)
+
+
+@benchmark("apply-varargs")
+def apply_varargs() -> Operation:
+    commands = _registry()
+    context = new_context(commands)
+    command = command_binding("echo", lambda text="": text, varargs=True)
+    arguments = ["one", "two", "three", "four"]
+    return lambda: apply_call(context, command, "echo", arguments)
+
+
+NESTED_SCRIPT = "echo [upper [reverse [cat3 a b c]]] [concat x y z] [echo 1 2 3]"
+
+
+@benchmark("nested")
+def nested() -> Operation:
+    commands = _registry()
+    return lambda: interpret(new_context(commands), NESTED_SCRIPT)
+
+
+@benchmark("nested-untraced")
+def nested_untraced() -> Operation:
+    commands = _registry()
+    return lambda: interpret(new_context(commands, trace=NoTrace()), NESTED_SCRIPT)
+
+
+def _large_registry() -> CommandRegistry:
+    commands = CommandRegistry()
+    for group_index in range(10):
+        group = commands.new_command_group(f"group{group_index}")
+        for command_index in range(30):
+            group.register_command(f"cmd-{group_index}-{command_index}", lambda: "")
+    return commands
+
+
+@benchmark("lookup-last")
+def lookup_last() -> Operation:
+    commands = _large_registry()
+    return lambda: commands.lookup_command("cmd-9-29")
+
+
+@benchmark("lookup-missing")
+def lookup_missing() -> Operation:
+    commands = _large_registry()
+    return lambda: commands.lookup_command("no-such-command")
+
+
+@benchmark("lookup-pattern")
+def lookup_pattern() -> Operation:
+    group = PythonCommandGroup()
+    for i in range(20):
+        group.register_command(re.compile(f"^p{i}o+fify$"), lambda: "")
+    group.register_command(re.compile("^kloo+fify$"), lambda: "")
+    commands = CommandRegistry({"patterns": group})
+    return lambda: commands.lookup_command("kloooooofify")
+
+
+class _BenchBot:
+    def __init__(self) -> None:
+        self.state_dir = "/nonexistent"
+        self.commands = CommandRegistry()
+        self.last_contexts: Dict[object, Context] = {}
+
+    def new_command_group(self, name: str) -> PythonCommandGroup:
+        return self.commands.new_command_group(name)
+
+
+def _bot_registry() -> CommandRegistry:
+    from pladder.plugins import builtin, misc
+    bot = _BenchBot()
+    for plugin in [builtin, misc]:
+        with plugin.pladder_plugin(bot):
+            pass
+    return bot.commands
+
+
+# Bodies of aliases and userdefs, in the style of the ones used in our channels
+ALIAS_TEMPLATE = "{Hej hej} [capify [reverse abc]] [concat a b c] [if [= a a] ja nej]"
+USERDEF_SCRIPT = "echo [capify $x]!! [first [reverse $x] $x] {(}[morse sos]{)}"
+
+
+# Aliases and userdefs stored in in-memory databases, like the ones
+# created with add-alias and def-command
+ALIAS_CORPUS = {
+    "hej": "{Hej hej} [capify [reverse abc]] [concat a b c] [if [= a a] ja nej]",
+    "morgon": "God morgon [capify världen]! [kloofify klofify]",
+    "kaffe": "[first kaffe te] eller [last kaffe te]? [nth 1 a b c]",
+}
+USERDEF_CORPUS = [
+    ("shout", ["x"], USERDEF_SCRIPT),
+    ("greet", ["who", "how"], "echo [capify $how] [shout $who]"),
+    ("twice", ["x"], "echo $x $x"),
+]
+
+
+def _db_registry() -> CommandRegistry:
+    from pladder.plugins.alias import AliasCommands, AliasDb
+    from pladder.plugins.userdef import UserdefCommands, UserdefDb
+    commands = _bot_registry()
+    alias_db = AliasDb(":memory:")
+    for name, template in ALIAS_CORPUS.items():
+        alias_db.add_alias(name, template)
+    AliasCommands(alias_db, commands)
+    userdef_db = UserdefDb(":memory:")
+    for name, params, script in USERDEF_CORPUS:
+        userdef_db.add_command(name, params, script)
+    UserdefCommands(userdef_db, commands)
+    return commands
+
+
+@benchmark("alias-db")
+def alias_db() -> Operation:
+    commands = _db_registry()
+    return lambda: interpret(new_context(commands), "echo [hej] [morgon] [kaffe]")
+
+
+@benchmark("userdef-db")
+def userdef_db() -> Operation:
+    commands = _db_registry()
+    return lambda: interpret(new_context(commands), "greet [twice hello] {good day}")
+
+
+@benchmark("repeat")
+def repeat() -> Operation:
+    commands = _bot_registry()
+    return lambda: interpret(new_context(commands), "repeat 20 {echo [capify abc] [reverse def]} ,")
+
+
+@benchmark("eval-varargs")
+def eval_varargs() -> Operation:
+    commands = _registry()
+    return lambda: interpret(new_context(commands), "echo one two three [echo four five six seven] eight")
+
+
+# The same list transformation, with the map builtin and with a recursive
+# userdef like the ones written before there were list builtins
+LIST_WORDS = "{" + " ".join(["kaffe", "te", "{varm choklad}", "saft"] * 10) + "}"
+RECURSIVE_CAPIFY_ALL = ("if [= [length $list] 1] [capify $list] "
+                        "[echo [capify [slice $list 0 1]] [capify-all [slice $list 1]]]")
+
+
+@benchmark("list-map")
+def list_map() -> Operation:
+    commands = _bot_registry()
+    return lambda: interpret(new_context(commands), f"map w {LIST_WORDS} {{capify $w}}")
+
+
+@benchmark("list-pipeline")
+def list_pipeline() -> Operation:
+    commands = _bot_registry()
+    script = f"length [filter w [slice [map w {LIST_WORDS} {{capify $w}}] 0 20] {{= $w Te}}]"
+    return lambda: interpret(new_context(commands), script)
+
+
+@benchmark("list-recursive-userdef")
+def list_recursive_userdef() -> Operation:
+    from pladder.plugins.userdef import UserdefCommands, UserdefDb
+    commands = _bot_registry()
+    userdef_db = UserdefDb(":memory:")
+    userdef_db.add_command("capify-all", ["list"], RECURSIVE_CAPIFY_ALL)
+    UserdefCommands(userdef_db, commands)
+    return lambda: interpret(new_context(commands), f"capify-all {LIST_WORDS}")
+
+
+def _walk_and_compiled(name: str, script: str, environment: Dict[str, str],
+                       registry: Callable[[], CommandRegistry] = _bot_registry) -> None:
+    def walk() -> Operation:
+        commands = registry()
+        call = parse(script)
+        return lambda: eval_call(new_context(commands, environment=environment), call)
+
+    def compiled() -> Operation:
+        commands = registry()
+        run = compile_call(parse(script))
+        return lambda: run(new_context(commands, environment=environment))
+
+    def vm() -> Operation:
+        commands = registry()
+        program = compile_program(parse(script))
+        return lambda: run_program(new_context(commands, environment=environment), program)
+
+    benchmark(f"walk-{name}")(walk)
+    benchmark(f"compiled-{name}")(compiled)
+    benchmark(f"vm-{name}")(vm)
+
+
+@benchmark("interpret-alias")
+def interpret_alias() -> Operation:
+    commands = _bot_registry()
+    script = "echo " + ALIAS_TEMPLATE
+    return lambda: interpret(new_context(commands), script)
+
+
+@benchmark("text-transforms")
+def text_transforms() -> Operation:
+    commands = _bot_registry()
+    script = "echo [kloooofify $x] [vråålify $x] [capify $x] [unicode-name $x]"
+    return lambda: interpret(new_context(commands, environment={"x": "pladder bot"}), script)
+
+
+@benchmark("if-untaken-branch")
+def if_untaken_branch() -> Operation:
+    commands = _bot_registry()
+    script = "if [= $x a] [reverse $x] [repeat 20 {capify [reverse abcdef]}]"
+    return lambda: interpret(new_context(commands, environment={"x": "a"}), script)
+
+
+def _deep_let_script(depth: int) -> str:
+    script = "echo $x $v0 $a"
+    for i in range(depth):
+        script = f"let x {i} v{i} {i} {{{script}}}"
+    return "repeat 5 {" + script + "}"
+
+
+@benchmark("deep-let")
+def deep_let() -> Operation:
+    commands = _bot_registry()
+    environment = {name: name.upper() for name in "abcdefghijklmnopqrst"}
+    script = _deep_let_script(12)
+    return lambda: interpret(new_context(commands, environment=environment), script)
+
+
+def _network_call(text: str) -> str:
+    time.sleep(0.005)
+    return text
+
+
+@benchmark("concurrent-io")
+def concurrent_io() -> Operation:
+    # Three sibling calls to a command that waits 5 ms, like a translation
+    group = PythonCommandGroup([
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("fetch", _network_call, concurrent=True),
+    ])
+    commands = CommandRegistry({"bench": group})
+    return lambda: interpret(new_context(commands), "echo [fetch en] [fetch de] [fetch sv]")
+
+
+async def _async_network_call(text: str) -> str:
+    await asyncio.sleep(0.005)
+    return text
+
+
+@benchmark("async-io")
+def async_io() -> Operation:
+    # Ten requests in flight, each waiting 5 ms for a command
+    group = PythonCommandGroup([
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("fetch", _async_network_call),
+    ])
+    commands = CommandRegistry({"bench": group})
+
+    async def requests() -> List[str]:
+        return await asyncio.gather(*[interpret_async(new_context(commands), f"echo [fetch {i}]") for i in range(10)])
+
+    return lambda: asyncio.run(requests())
+
+
+_walk_and_compiled("alias", "echo " + ALIAS_TEMPLATE, {})
+_walk_and_compiled("userdef", USERDEF_SCRIPT, {"x": "hello"})
+_walk_and_compiled("db", "echo [greet [twice hello] {good day}] [hej]", {}, _db_registry)
+
+
+def _countdown_body(context: Context, n: str) -> Tuple[Context, str]:
+    if n == "0":
+        return context, "echo done"
+    else:
+        return context._replace(environment={"n": str(int(n) - 1)}), "countdown $n"
+
+
+def _countdown_registry() -> CommandRegistry:
+    group = PythonCommandGroup([
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("countdown", lambda context, n: interpret(*_countdown_body(context, n)),
+                        contextual=True, body=_countdown_body),
+    ])
+    return CommandRegistry({"bench": group})
+
+
+@benchmark("compiled-recursion")
+def compiled_recursion() -> Operation:
+    commands = _countdown_registry()
+    return lambda: interpret(new_context(commands), "countdown 50")
+
+
+@benchmark("vm-recursion")
+def vm_recursion() -> Operation:
+    commands = _countdown_registry()
+    program = compile_program(parse("countdown 50"))
+    return lambda: run_program(new_context(commands), program)
+
+
+def ast_corpus() -> List[str]:
+    # A stand-in for the aliases and userdefs of a busy bot
+    return [script.replace("abc", f"abc{i}")
+            for i in range(500)
+            for script in ["echo " + ALIAS_TEMPLATE, USERDEF_SCRIPT, NESTED_SCRIPT]]
+
+
+def ast_footprint(calls: List[Call]) -> int:
+    # Total size in bytes of all distinct objects reachable from the trees
+    seen = set()
+    total = 0
+    stack: List[object] = list(calls)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, Node):
+            stack.extend(getattr(obj, name) for name in obj.__slots__)
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return total
+
+
+class Result(NamedTuple):
+    ops_per_sec: float
+    # Peak memory allocated (and not yet freed) during one operation
+    peak_bytes: int
+
+
+def run_benchmark(setup: Setup, min_time: float = 0.2) -> float:
+    timer = timeit.Timer(setup())
+    count, _ = timer.autorange()
+    count = max(count, 1)
+    elapsed = min(timer.repeat(repeat=3, number=count))
+    if elapsed < min_time:
+        count = int(count * min_time / max(elapsed, 1e-9))
+        elapsed = timer.timeit(number=count)
+    return count / elapsed
+
+
+def measure_peak_bytes(setup: Setup) -> int:
+    operation = setup()
+    operation()  # Warm up caches, so that only the operation itself is measured
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(peak - baseline, 0)
+
+
+def run_benchmarks(names: List[str]) -> Dict[str, Result]:
+    results = {}
+    for name in names:
+        results[name] = Result(run_benchmark(BENCHMARKS[name]), measure_peak_bytes(BENCHMARKS[name]))
+    return results
+
+
+def save_results(path: str, results: Dict[str, Result]) -> None:
+    data = {
+        "version": 1,
+        "python": f"{platform.python_implementation()} {platform.python_version()}",
+        "results": {name: result._asdict() for name, result in results.items()},
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+
+def load_results(path: str) -> Dict[str, Result]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return {name: Result(**result) for name, result in data["results"].items()}
+
+
+def format_result(name: str, result: Result, baseline: Optional[Result] = None) -> str:
+    line = f"{name:<24} {result.ops_per_sec:>14,.0f} ops/s {result.peak_bytes:>12,} B peak"
+    if baseline is not None:
+        change = result.ops_per_sec / baseline.ops_per_sec - 1
+        line += f"   {change:+.0%} ops/s vs {baseline.ops_per_sec:,.0f}"
+    return line
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Run PladderScript micro-benchmarks")
+    parser.add_argument("names", nargs="*", metavar="NAME",
+                        help="Benchmarks to run (default: all). Available: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--ast-memory", action="store_true",
+                        help="Report the memory used by the parsed trees of a corpus of scripts")
+    parser.add_argument("--json", metavar="PATH", help="Save the results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="Compare with results saved with --json")
+    args = parser.parse_args(argv)
+    if args.ast_memory:
+        corpus = ast_corpus()
+        footprint = ast_footprint([parse(script) for script in corpus])
+        print(f"{len(corpus)} scripts: {footprint / 1024:,.0f} kB of syntax trees")
+        return
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("Unknown benchmarks: " + ", ".join(unknown))
+    baselines = load_results(args.compare) if args.compare else {}
+    results = {}
+    for name in names:
+        [result] = run_benchmarks([name]).values()
+        results[name] = result
+        print(format_result(name, result, baselines.get(name)))
+    if args.json:
+        save_results(args.json, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, NamedTuple, Optional, TypeVar
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    max_size: int
+
+
+def _unit_size(_value: object) -> int:
+    return 1
+
+
+class LruCache(Generic[K, V]):
+    """A bounded mapping that evicts the least recently used entries first.
+
+    The size of an entry is given by `size_of` (1 per entry by default),
+    and entries are evicted until the total size fits within `max_size`.
+    """
+
+    def __init__(self, max_size: int, size_of: Callable[[V], int] = _unit_size) -> None:
+        self._entries: "OrderedDict[K, V]" = OrderedDict()
+        self._size_of = size_of
+        self._size = 0
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def get(self, key: K) -> Optional[V]:
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: K, value: V) -> None:
+        if key in self._entries:
+            self._size -= self._size_of(self._entries.pop(key))
+        size = self._size_of(value)
+        if size > self.max_size:
+            return
+        self._entries[key] = value
+        self._size += size
+        while self._size > self.max_size:
+            _key, evicted = self._entries.popitem(last=False)
+            self._size -= self._size_of(evicted)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(self.hits, self.misses, self.evictions, self._size, self.max_size)
@@ -0,0 +1,70 @@
+"""Static estimates of the number of command applications a script makes.
+
+The estimate is made from the parsed script before it is run, so that a
+script that is sure to run out of budget (e.g. nested `repeat 1000`) can
+be refused without spending any time on it. Each call counts as one
+application, plus the calls in its words. Commands that run scripts given
+as arguments provide a cost function (see CommandBinding.cost).
+
+What is only known at run time (repeat counts and scripts that are not
+literals, the bodies of userdefs and aliases) is counted as a single
+application, so the estimate only grows with what is known for sure.
+The arguments of lazy commands (e.g. conditionals) are counted by their
+cost functions, which count the branch that is taken if the condition is
+a literal, and otherwise the most expensive branch.
+"""
+
+from typing import Optional
+
+from .interpreter import compile, literal_string
+from .types import ArgumentCost, BudgetExceeded, BudgetLimits, Call, CommandRegistry, ParseError, Word
+
+
+def estimate_applications(call: Call, commands: CommandRegistry) -> int:
+    return _Estimator(commands).call_cost(call)
+
+
+def check_cost(call: Call, commands: CommandRegistry, limits: BudgetLimits) -> None:
+    estimate = estimate_applications(call, commands)
+    if estimate > limits.max_applications:
+        raise BudgetExceeded(f"Script refused: estimated to make {estimate} command applications "
+                             f"(the limit is {limits.max_applications})")
+
+
+class _Estimator:
+    def __init__(self, commands: CommandRegistry) -> None:
+        self.commands = commands
+
+    def call_cost(self, call: Call) -> int:
+        if not call.words:
+            return 0
+        command_name = literal_string(call.words[0])
+        command = None if command_name is None else self.commands.lookup_command(command_name)
+        if command is not None and command.lazy and command.cost is not None:
+            argument_costs = [ArgumentCost(literal_string(word), self.word_cost(word)) for word in call.words[1:]]
+            try:
+                return 1 + command.cost(*argument_costs)
+            except (TypeError, ValueError):
+                return 1 + sum(argument.cost for argument in argument_costs)
+        cost = 1 + sum(self.word_cost(word) for word in call.words)
+        if command is not None and command.cost is not None:
+            arguments = [literal_string(word) for word in call.words[1:]]
+            try:
+                cost += command.cost(self.script_cost, *arguments)
+            except (TypeError, ValueError):
+                # E.g. the wrong number of arguments, or a count that is not
+                # a number. Left to fail when the script is run.
+                pass
+        return cost
+
+    def word_cost(self, word: Word) -> int:
+        return sum(self.call_cost(fragment) for fragment in word.fragments if isinstance(fragment, Call))
+
+    def script_cost(self, script: Optional[str]) -> int:
+        if script is None:
+            return 1
+        try:
+            call = compile(script)
+        except ParseError:
+            return 0
+        return self.call_cost(call)
@@ -1,40 +1,221 @@
-from inspect import signature, Parameter
-from typing import Any, Callable, List
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Generator, List, NamedTuple, Optional, Sequence, \
+    Tuple, TypeVar, Union, cast
 
-from .parser import parse
-from .types import ApplyError, Call, CommandBinding, Context, EvalError, Literal, Result, TraceEntry
+from .cache import CacheStats, LruCache
+from .memo import memo
+from .parser import parse, unparse_word
+from .types import ApplyError, Call, CallSite, CommandBinding, CommandRegistry, Context, EvalError, Fragment, Literal, \
+    Result, Trace, TraceEntry, Variable, Word, new_context
+
+
+CompiledCall = Callable[[Context], Result]
+CompiledWord = Callable[[Context], str]
+AsyncWord = Callable[[Context], Awaitable[str]]
+
+
+class TailCall(NamedTuple):
+    # A call to a body command in tail position, left for the caller to apply
+    command: CommandBinding
+    command_name: str
+    arguments: List[str]
+
+
+CompiledTailCall = Callable[[Context], Union[Result, TailCall]]
+# How a compiled call applies the command: invoke, or _invoke_or_tail_call
+# for the top level call of the script of a body command
+Applied = TypeVar("Applied", Result, Union[Result, TailCall])
+Invoker = Callable[[Context, CommandBinding, str, List[str]], Applied]
+
+
+class Thunk:
+    """An unevaluated argument of a lazy command.
+
+    Calling the thunk evaluates the word in the context of the call. The
+    word is evaluated at most once. Hybrid lazy commands await the thunk
+    instead, which evaluates the word asynchronously if the call is
+    evaluated by interpret_async.
+    """
+
+    __slots__ = ["word", "_evaluate", "_evaluate_async", "_context", "_value"]
+
+    def __init__(self, word: Word, evaluate: CompiledWord, context: Optional[Context],
+                 evaluate_async: Optional[AsyncWord] = None) -> None:
+        self.word = word
+        self._evaluate = evaluate
+        self._evaluate_async = evaluate_async
+        self._context = context
+        self._value: Optional[str] = None
+
+    @classmethod
+    def evaluated(cls, value: str) -> "Thunk":
+        thunk = cls(Word([Literal(value)]), _constant(value), None)
+        thunk._value = value
+        return thunk
+
+    def __call__(self) -> str:
+        if self._value is None:
+            assert self._context is not None
+            self._value = self._evaluate(self._context)
+        return self._value
+
+    def __await__(self) -> Generator[Any, None, str]:
+        if self._value is None:
+            assert self._context is not None
+            if self._evaluate_async is None:
+                self._value = self._evaluate(self._context)
+            else:
+                self._value = yield from self._evaluate_async(self._context).__await__()
+        return self._value
+
+    def __str__(self) -> str:
+        return unparse_word(self.word)
+
+
+Argument = Union[str, Thunk]
+# The words of a lazy call, and how to evaluate each of them
+LazyWords = Sequence[Tuple[Word, CompiledWord]]
+
+
+class CompiledScript(NamedTuple):
+    call: Call
+    # Compiled (with constants folded) for the registry generation below
+    run: Optional[CompiledCall] = None
+    generation: int = 0
+    # Compiled for running as the script of a body command (see _run_body)
+    tail_run: Optional[CompiledTailCall] = None
+    tail_generation: int = 0
+
+
+SCRIPT_CACHE_SIZE = 1024
+
+_script_cache: LruCache[str, CompiledScript] = LruCache(SCRIPT_CACHE_SIZE)
 
 
 def interpret(context: Context, script: str) -> Result:
-    call = parse(script)
-    return eval_call(context, call)
+    compiled = _cached_script(script)
+    generation = context.commands.generation
+    if compiled.run is None or compiled.generation != generation:
+        run = compile_call(fold_constants(compiled.call, context.commands))
+        compiled = compiled._replace(run=run, generation=generation)
+        _script_cache.put(script, compiled)
+        return run(context)
+    return compiled.run(context)
+
+
+def _compiled_tail_call(context: Context, script: str) -> CompiledTailCall:
+    compiled = _cached_script(script)
+    generation = context.commands.generation
+    if compiled.tail_run is None or compiled.tail_generation != generation:
+        tail_run = _compile_call(fold_constants(compiled.call, context.commands), _invoke_or_tail_call)
+        _script_cache.put(script, compiled._replace(tail_run=tail_run, tail_generation=generation))
+        return tail_run
+    return compiled.tail_run
+
+
+def compile(script: str) -> Call:
+    return _cached_script(script).call
+
+
+def preload_script(script: str, load: Callable[[], Optional[Call]]) -> None:
+    # Adds a script that was parsed earlier (e.g. a tree stored in a
+    # database) to the cache, unless it is already there. `load` may return
+    # None, and the script is then parsed when it is first run.
+    if script not in _script_cache:
+        call = load()
+        if call is not None:
+            _script_cache.put(script, CompiledScript(call))
+
+
+def _cached_script(script: str) -> CompiledScript:
+    compiled = _script_cache.get(script)
+    if compiled is None:
+        compiled = CompiledScript(parse(script))
+        _script_cache.put(script, compiled)
+    return compiled
+
+
+def eval_compiled(context: Context, call: Call) -> Result:
+    # Like interpret, but the compiled call is kept on the call itself
+    generation = context.commands.generation
+    compiled = call.compiled
+    if compiled is None or compiled[0] != generation:
+        run = compile_call(fold_constants(call, context.commands))
+        call.compiled = (generation, run)
+        return run(context)
+    return compiled[1](context)
+
+
+def parse_cache_stats() -> CacheStats:
+    return _script_cache.stats()
 
 
 def eval_call(context: Context, call: Call) -> Result:
-    evaled_words = []
-    for word in call.words:
-        evaled_fragments = []
-        for fragment in word.fragments:
-            if isinstance(fragment, Literal):
-                evaled_fragment = fragment.string
-            elif isinstance(fragment, Call):
-                evaled_fragment = eval_call(context, fragment)
-            else:
-                try:
-                    evaled_fragment = context.environment[fragment.name]
-                except KeyError:
-                    raise EvalError(f"Unbound variable: {fragment.name}")
-            evaled_fragments.append(evaled_fragment)
-        evaled_word = "".join(evaled_fragments)
-        evaled_words.append(evaled_word)
-    if not evaled_words:
+    if not call.words:
         return ""
-    command_name, arguments = evaled_words[0], evaled_words[1:]
-    command = context.commands.lookup_command(command_name)
+    command_name = eval_word(context, call.words[0])
+    site = _call_site(call)
+    command = site.lookup(context.commands, command_name)
+    if command is not None and command.lazy:
+        lazy_words = [(word, _word_evaluator(word)) for word in call.words[1:]]
+        return invoke_lazy(context, command, command_name, lazy_words)
+    generation = context.commands.generation
+    arguments = [eval_word(context, word) for word in call.words[1:]]
+    if context.commands.generation != generation:
+        # Evaluating the arguments changed the commands
+        command = site.lookup(context.commands, command_name)
     if command is None:
         raise EvalError(f"Unknown command name: {command_name}")
-    subtrace: List[TraceEntry] = []
-    command_context = context._replace(command_name=command_name, trace=subtrace)
+    return invoke(context, command, command_name, arguments)
+
+
+def _call_site(call: Call) -> CallSite:
+    site = call.call_site
+    if site is None:
+        site = call.call_site = CallSite()
+    return site
+
+
+def eval_word(context: Context, word: Word) -> str:
+    evaled_fragments = []
+    for fragment in word.fragments:
+        if isinstance(fragment, Literal):
+            evaled_fragment = fragment.string
+        elif isinstance(fragment, Call):
+            evaled_fragment = eval_call(context, fragment)
+        else:
+            try:
+                evaled_fragment = context.environment[fragment.name]
+            except KeyError:
+                raise EvalError(f"Unbound variable: {fragment.name}")
+        evaled_fragments.append(evaled_fragment)
+    if len(evaled_fragments) == 1:
+        # Keeps structured values (see pladder.script.values) that are not
+        # concatenated with anything
+        return evaled_fragments[0]
+    return "".join(evaled_fragments)
+
+
+def _word_evaluator(word: Word) -> CompiledWord:
+    def evaluate(context: Context) -> str:
+        return eval_word(context, word)
+
+    return evaluate
+
+
+def invoke(context: Context, command: CommandBinding, command_name: str, arguments: List[str]) -> Result:
+    # Only contextual commands get to see the context, so the context of the
+    # command (with its name and subtrace) is only made for them.
+    if not context.trace.enabled:
+        if command.contextual:
+            return apply_call(context._replace(command_name=command_name), command, command_name, arguments)
+        return apply_call(context, command, command_name, arguments)
+    subtrace = context.trace.subtrace()
+    if command.contextual:
+        command_context = context._replace(command_name=command_name, trace=subtrace)
+    else:
+        command_context = context
     try:
         result = apply_call(command_context, command, command_name, arguments)
         trace_entry = TraceEntry(command, command_name, arguments, subtrace, result)
@@ -46,40 +227,583 @@ def eval_call(context: Context, call: Call) -> Result:
     return result
 
 
-def apply_call(context: Context, command: CommandBinding, command_name: str, arguments: List[str]) -> str:
+def _invoke_or_tail_call(context: Context, command: CommandBinding, command_name: str,
+                         arguments: List[str]) -> Union[Result, TailCall]:
+    if command.body is not None and not command.memoize and not command.lazy:
+        return TailCall(command, command_name, arguments)
+    return invoke(context, command, command_name, arguments)
+
+
+def _run_body(context: Context, script: str) -> Result:
+    # Runs the script of a body command. When the script ends with a call to
+    # another body command (a tail call), this loop runs the script of that
+    # command instead of recursing, so recursive userdefs and aliases run in
+    # constant stack. The tail calls are traced and profiled as usual, but
+    # their entries are completed when the last one returns.
+    tail_calls: List[Tuple[Context, TailCall, Trace]] = []
+    try:
+        while True:
+            result = _compiled_tail_call(context, script)(context)
+            if not isinstance(result, TailCall):
+                break
+            command, command_name, arguments = result
+            if context.budget is not None:
+                context.budget.charge()
+            subtrace = context.trace.subtrace()
+            if command.contextual:
+                command_context = context._replace(command_name=command_name, trace=subtrace)
+            else:
+                command_context = context
+            tail_calls.append((context, result, subtrace))
+            if context.profile is not None:
+                context.profile.start(command_name)
+            fn_arguments = bind_arguments(command_context, command, command_name, arguments)
+            assert command.body is not None
+            context, script = command.body(*fn_arguments)
+    except Exception as e:
+        _finish_tail_calls(tail_calls, e)
+        raise
+    _finish_tail_calls(tail_calls, result)
+    return result
+
+
+def _finish_tail_calls(tail_calls: List[Tuple[Context, TailCall, Trace]], result: Union[str, Exception]) -> None:
+    for context, (command, command_name, arguments), subtrace in reversed(tail_calls):
+        if context.profile is not None:
+            context.profile.stop(command_name)
+        context.trace.append(TraceEntry(command, command_name, arguments, subtrace, result))
+
+
+def invoke_lazy(context: Context, command: CommandBinding, command_name: str, lazy_words: LazyWords) -> Result:
+    # The words are evaluated in the caller's context when (and if) the
+    # command calls their thunks. Since this happens while the command runs,
+    # the calls they make are traced as part of the command.
+    if not context.trace.enabled:
+        thunks = [Thunk(word, evaluate, context) for word, evaluate in lazy_words]
+        return apply_call(context._replace(command_name=command_name), command, command_name, thunks)
+    subtrace = context.trace.subtrace()
+    thunk_context = context._replace(trace=subtrace)
+    thunks = [Thunk(word, evaluate, thunk_context) for word, evaluate in lazy_words]
+    sources = [str(thunk) for thunk in thunks]
+    command_context = context._replace(command_name=command_name, trace=subtrace)
+    try:
+        result = apply_call(command_context, command, command_name, thunks)
+        context.trace.append(TraceEntry(command, command_name, sources, subtrace, result))
+    except Exception as e:
+        context.trace.append(TraceEntry(command, command_name, sources, subtrace, e))
+        raise
+    return result
+
+
+# Constant folding evaluates calls to pure commands whose words are all
+# literals once, and replaces them with their results. The top level call
+# of a script is never folded, so running a script always makes at least
+# one command application (which e.g. last-output relies on).
+
+def fold_constants(call: Call, commands: CommandRegistry) -> Call:
+    return Call([_fold_word(word, commands) for word in call.words])
+
+
+def _fold_word(word: Word, commands: CommandRegistry) -> Word:
+    fragments: List[Fragment] = []
+    for fragment in word.fragments:
+        if isinstance(fragment, Call):
+            fragments.append(_fold_call(fragment, commands))
+        else:
+            fragments.append(fragment)
+    return Word(fragments)
+
+
+def _fold_call(call: Call, commands: CommandRegistry) -> Fragment:
+    folded = fold_constants(call, commands)
+    if not folded.words:
+        return Literal("")
+    words = []
+    for word in folded.words:
+        string = literal_string(word)
+        if string is None:
+            return folded
+        words.append(string)
+    command_name, arguments = words[0], words[1:]
+    command = commands.lookup_command(command_name)
+    if command is None or not command.pure:
+        return folded
+    try:
+        result = apply_call(new_context(commands, command_name=command_name), command, command_name, arguments)
+    except Exception:
+        # Leave it to be evaluated (and fail) at run time
+        return folded
+    return Literal(result)
+
+
+# The compiler turns a Call tree into nested closures that do the same
+# thing as eval_call, but decide once (at compile time) how each word and
+# fragment is evaluated. Like in eval_call, each call resolves its command
+# through a CallSite, once per registry generation (and command name).
+# Calls whose arguments are all literals are never lazy: a lazy command
+# gets thunks of the literal strings instead.
+
+
+def compile_call(call: Call) -> CompiledCall:
+    return _compile_call(call, invoke)
+
+
+def _compile_call(call: Call, apply: Invoker[Applied]) -> Callable[[Context], Applied]:
+    if not call.words:
+        return _constant("")
+    words = [_compile_word(word) for word in call.words]
+    lazy_words: Optional[LazyWords] = None
+    if any(literal_string(word) is None for word in call.words[1:]):
+        lazy_words = list(zip(call.words[1:], words[1:]))
+    command_name = literal_string(call.words[0])
+    if command_name is None:
+        return _compile_dynamic_call(words[0], words[1:], lazy_words, apply)
+    compiled = _compile_static_call(command_name, words[1:], lazy_words, apply)
+    candidates = _concurrent_candidates(call.words[1:])
+    if len(candidates) >= 2:
+        return _compile_concurrent_call(command_name, words[1:], candidates, compiled, apply)
+    return compiled
+
+
+def _compile_static_call(command_name: str, argument_words: List[CompiledWord],
+                         lazy_words: Optional[LazyWords], apply: Invoker[Applied]) -> Callable[[Context], Applied]:
+    site = CallSite()
+
+    def eval_static_call(context: Context) -> Applied:
+        arguments = [word(context) for word in argument_words]
+        command = site.lookup(context.commands, command_name)
+        if command is None:
+            raise EvalError(f"Unknown command name: {command_name}")
+        return apply(context, command, command_name, arguments)
+
+    def eval_maybe_lazy_static_call(context: Context) -> Applied:
+        command = site.lookup(context.commands, command_name)
+        if command is not None and command.lazy:
+            assert lazy_words is not None
+            return invoke_lazy(context, command, command_name, lazy_words)
+        return eval_static_call(context)
+
+    return eval_static_call if lazy_words is None else eval_maybe_lazy_static_call
+
+
+def _compile_dynamic_call(name_word: CompiledWord, argument_words: List[CompiledWord],
+                          lazy_words: Optional[LazyWords], apply: Invoker[Applied]) -> Callable[[Context], Applied]:
+    site = CallSite()
+
+    def eval_dynamic_call(context: Context) -> Applied:
+        command_name = name_word(context)
+        command = site.lookup(context.commands, command_name)
+        if lazy_words is not None and command is not None and command.lazy:
+            return invoke_lazy(context, command, command_name, lazy_words)
+        generation = context.commands.generation
+        arguments = [word(context) for word in argument_words]
+        if context.commands.generation != generation:
+            command = site.lookup(context.commands, command_name)
+        if command is None:
+            raise EvalError(f"Unknown command name: {command_name}")
+        return apply(context, command, command_name, arguments)
+
+    return eval_dynamic_call
+
+
+# Arguments that are calls to concurrent commands (see CommandBinding) are
+# started together on a thread pool before the arguments are evaluated,
+# and their results are collected (and traced) in order as the arguments
+# are evaluated from left to right. Only calls whose words are all
+# literals and variables qualify. The calls may run in any order, and
+# they run even if evaluating an argument to their left fails, which is
+# why concurrent commands must not have side effects.
+
+CONCURRENT_WORKERS = 8
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+class _ConcurrentCandidate(NamedTuple):
+    position: int
+    command_name: str
+    argument_words: List[CompiledWord]
+    site: CallSite
+
+
+class _StartedCall(NamedTuple):
+    command: CommandBinding
+    command_name: str
+    arguments: List[str]
+    future: "Future[str]"
+
+
+def _concurrent_candidates(argument_words: Sequence[Word]) -> List[_ConcurrentCandidate]:
+    candidates = []
+    for position, word in enumerate(argument_words):
+        if len(word.fragments) != 1 or not isinstance(word.fragments[0], Call):
+            continue
+        call = word.fragments[0]
+        command_name = literal_string(call.words[0]) if call.words else None
+        if command_name is None:
+            continue
+        if any(isinstance(fragment, Call) for call_word in call.words for fragment in call_word.fragments):
+            continue
+        candidates.append(_ConcurrentCandidate(position, command_name,
+                                               [_compile_word(call_word) for call_word in call.words[1:]],
+                                               CallSite()))
+    return candidates
+
+
+def _compile_concurrent_call(command_name: str, argument_words: List[CompiledWord],
+                             candidates: List[_ConcurrentCandidate], sequential: Callable[[Context], Applied],
+                             apply: Invoker[Applied]) -> Callable[[Context], Applied]:
+    # Whether at least two candidates call concurrent commands (and the
+    # command is not lazy), for the registry generation
+    cached = (0, False)
+    site = CallSite()
+
+    def eval_concurrent_call(context: Context) -> Applied:
+        nonlocal cached
+        generation, worth_trying = cached
+        if generation != context.commands.generation:
+            worth_trying = _worth_trying_concurrently(context.commands, command_name, candidates)
+            cached = (context.commands.generation, worth_trying)
+        if not worth_trying or context.profile is not None:
+            return sequential(context)
+        started = _start_concurrent_calls(context, candidates)
+        if started is None:
+            return sequential(context)
+        arguments = []
+        for position, word in enumerate(argument_words):
+            started_call = started.get(position)
+            if started_call is None:
+                arguments.append(word(context))
+            else:
+                arguments.append(_collect_concurrent_call(context, started_call))
+        command = site.lookup(context.commands, command_name)
+        if command is None:
+            raise EvalError(f"Unknown command name: {command_name}")
+        return apply(context, command, command_name, arguments)
+
+    return eval_concurrent_call
+
+
+def _worth_trying_concurrently(commands: CommandRegistry, command_name: str,
+                               candidates: List[_ConcurrentCandidate]) -> bool:
+    command = commands.lookup_command(command_name)
+    if command is None or command.lazy:
+        return False
+    concurrent_commands = [commands.lookup_command(candidate.command_name) for candidate in candidates]
+    return sum(1 for command in concurrent_commands if command is not None and command.concurrent) >= 2
+
+
+def _start_concurrent_calls(context: Context,
+                            candidates: List[_ConcurrentCandidate]) -> Optional[Dict[int, _StartedCall]]:
+    ready = []
+    for candidate in candidates:
+        command = candidate.site.lookup(context.commands, candidate.command_name)
+        if command is None or not command.concurrent:
+            continue
+        try:
+            arguments = [word(context) for word in candidate.argument_words]
+        except EvalError:
+            # Left to fail when the argument is evaluated in order
+            continue
+        ready.append((candidate.position, command, candidate.command_name, arguments))
+    if len(ready) < 2:
+        return None
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(CONCURRENT_WORKERS, thread_name_prefix="pladder-script")
+    # The budget is charged when the results are collected, in this thread
+    unbudgeted_context = context._replace(budget=None)
+    return {position: _StartedCall(command, command_name, arguments,
+                                   _executor.submit(apply_call, unbudgeted_context, command, command_name, arguments))
+            for position, command, command_name, arguments in ready}
+
+
+def _collect_concurrent_call(context: Context, started_call: _StartedCall) -> str:
+    command, command_name, arguments, future = started_call
+    subtrace = context.trace.subtrace()
+    budget = context.budget
+    try:
+        if budget is not None:
+            budget.charge()
+        result = future.result()
+        if budget is not None:
+            budget.check_string(result)
+    except Exception as e:
+        context.trace.append(TraceEntry(command, command_name, arguments, subtrace, e))
+        raise
+    context.trace.append(TraceEntry(command, command_name, arguments, subtrace, result))
+    return result
+
+
+def _compile_word(word: Word) -> CompiledWord:
+    fragments = _join_literals(word.fragments)
+    if not fragments:
+        return _constant("")
+    elif len(fragments) == 1:
+        return _compile_fragment(fragments[0])
+    compiled_fragments = [_compile_fragment(fragment) for fragment in fragments]
+
+    def eval_word(context: Context) -> str:
+        return "".join([fragment(context) for fragment in compiled_fragments])
+
+    return eval_word
+
+
+def _join_literals(fragments: Sequence[Fragment]) -> List[Fragment]:
+    result: List[Fragment] = []
+    for fragment in fragments:
+        if isinstance(fragment, Literal) and result and isinstance(result[-1], Literal):
+            result[-1] = Literal(result[-1].string + fragment.string)
+        else:
+            result.append(fragment)
+    return result
+
+
+def literal_string(word: Word) -> Optional[str]:
+    strings = []
+    for fragment in word.fragments:
+        if not isinstance(fragment, Literal):
+            return None
+        strings.append(fragment.string)
+    return "".join(strings)
+
+
+def _compile_fragment(fragment: Fragment) -> CompiledWord:
+    if isinstance(fragment, Literal):
+        return _constant(fragment.string)
+    elif isinstance(fragment, Call):
+        return compile_call(fragment)
+    else:
+        return _compile_variable(fragment)
+
+
+def _compile_variable(variable: Variable) -> CompiledWord:
+    name = variable.name
+
+    def eval_variable(context: Context) -> str:
+        try:
+            return context.environment[name]
+        except KeyError:
+            raise EvalError(f"Unbound variable: {name}")
+
+    return eval_variable
+
+
+def _constant(value: str) -> CompiledWord:
+    def eval_constant(context: Context) -> str:
+        return value
+
+    return eval_constant
+
+
+# Asynchronous evaluation: asynchronous commands are awaited, so many
+# scripts that wait for slow commands can be in flight at once on one event
+# loop. Commands with a body (aliases and userdefs) are evaluated
+# asynchronously as well, and so are the thunks and scripts that hybrid
+# commands (e.g. conditionals and eval) await. Other commands are applied
+# as usual, and evaluate their lazy arguments and scripts synchronously.
+
+async def interpret_async(context: Context, script: str) -> Result:
+    return await eval_call_async(context, compile(script))
+
+
+async def eval_call_async(context: Context, call: Call) -> Result:
+    if not call.words:
+        return ""
+    command_name = await eval_word_async(context, call.words[0])
+    site = _call_site(call)
+    command = site.lookup(context.commands, command_name)
+    if command is not None and command.lazy:
+        lazy_words = [(word, _word_evaluator(word)) for word in call.words[1:]]
+        return await invoke_lazy_async(context, command, command_name, lazy_words)
+    generation = context.commands.generation
+    arguments = [await eval_word_async(context, word) for word in call.words[1:]]
+    if context.commands.generation != generation:
+        command = site.lookup(context.commands, command_name)
+    if command is None:
+        raise EvalError(f"Unknown command name: {command_name}")
+    return await invoke_async(context, command, command_name, arguments)
+
+
+async def eval_word_async(context: Context, word: Word) -> str:
+    evaled_fragments = []
+    for fragment in word.fragments:
+        if isinstance(fragment, Literal):
+            evaled_fragment = fragment.string
+        elif isinstance(fragment, Call):
+            evaled_fragment = await eval_call_async(context, fragment)
+        else:
+            try:
+                evaled_fragment = context.environment[fragment.name]
+            except KeyError:
+                raise EvalError(f"Unbound variable: {fragment.name}")
+        evaled_fragments.append(evaled_fragment)
+    if len(evaled_fragments) == 1:
+        # Keeps structured values (see pladder.script.values) that are not
+        # concatenated with anything
+        return evaled_fragments[0]
+    return "".join(evaled_fragments)
+
+
+async def run_script(context: Context, script: str) -> Result:
+    # Runs a script for a hybrid command: asynchronously when the command is
+    # evaluated by interpret_async, and otherwise without suspending
+    if context.asynchronous:
+        return await interpret_async(context, script)
+    return interpret(context, script)
+
+
+def _async_word_evaluator(word: Word) -> AsyncWord:
+    def evaluate(context: Context) -> Awaitable[str]:
+        return eval_word_async(context, word)
+    return evaluate
+
+
+async def invoke_lazy_async(context: Context, command: CommandBinding, command_name: str,
+                            lazy_words: LazyWords) -> Result:
+    # Like invoke_lazy, but hybrid commands await the thunks asynchronously
+    if not context.trace.enabled:
+        thunks = [Thunk(word, evaluate, context, _async_word_evaluator(word)) for word, evaluate in lazy_words]
+        return await apply_call_async(context._replace(command_name=command_name), command, command_name, thunks)
+    subtrace = context.trace.subtrace()
+    thunk_context = context._replace(trace=subtrace)
+    thunks = [Thunk(word, evaluate, thunk_context, _async_word_evaluator(word)) for word, evaluate in lazy_words]
+    sources = [str(thunk) for thunk in thunks]
+    command_context = context._replace(command_name=command_name, trace=subtrace)
+    try:
+        result = await apply_call_async(command_context, command, command_name, thunks)
+        context.trace.append(TraceEntry(command, command_name, sources, subtrace, result))
+    except Exception as e:
+        context.trace.append(TraceEntry(command, command_name, sources, subtrace, e))
+        raise
+    return result
+
+
+async def invoke_async(context: Context, command: CommandBinding, command_name: str, arguments: List[str]) -> Result:
+    subtrace = context.trace.subtrace()
+    if command.contextual:
+        command_context = context._replace(command_name=command_name, trace=subtrace)
+    else:
+        command_context = context
+    try:
+        result = await apply_call_async(command_context, command, command_name, arguments)
+    except Exception as e:
+        context.trace.append(TraceEntry(command, command_name, arguments, subtrace, e))
+        raise
+    context.trace.append(TraceEntry(command, command_name, arguments, subtrace, result))
+    return result
+
+
+async def apply_call_async(context: Context, command: CommandBinding, command_name: str,
+                           arguments: Sequence[Argument]) -> str:
+    if not command.asynchronous and command.body is None:
+        return apply_call(context, command, command_name, arguments)
+    budget = context.budget
+    if budget is not None:
+        budget.charge()
+    if command.lazy:
+        arguments = [Thunk.evaluated(argument) if isinstance(argument, str) else argument
+                     for argument in arguments]
+    if command.hybrid and not context.asynchronous:
+        context = context._replace(asynchronous=True)
+    profile = context.profile
+    if profile is not None:
+        profile.start(command_name)
+    try:
+        fn_arguments = bind_arguments(context, command, command_name, arguments)
+        if command.body is not None:
+            body_context, script = command.body(*fn_arguments)
+            return await interpret_async(body_context, script)
+        result = await cast(Awaitable[str], command.fn(*fn_arguments))
+    finally:
+        if profile is not None:
+            profile.stop(command_name)
+    assert isinstance(result, str), f"Commands must return strings, got {type(result).__name__}"
+    if budget is not None:
+        budget.check_string(result)
+    return result
+
+
+def apply_call(context: Context, command: CommandBinding, command_name: str, arguments: Sequence[Argument]) -> str:
+    # Non-contextual commands are applied with the caller's context, which is
+    # then only used for its budget.
+    budget = context.budget
+    if budget is not None:
+        budget.charge()
+    if command.lazy:
+        arguments = [Thunk.evaluated(argument) if isinstance(argument, str) else argument
+                     for argument in arguments]
+    if command.hybrid and context.asynchronous:
+        # Evaluated synchronously, even if the caller was evaluated by
+        # interpret_async
+        context = context._replace(asynchronous=False)
+    profile = context.profile
+    if profile is not None:
+        profile.start(command_name)
+    try:
+        fn_arguments = bind_arguments(context, command, command_name, arguments)
+        result: Union[str, Awaitable[str]]
+        if command.memoize:
+            result = memo.call(command.display_name, command.fn, command_name, arguments, fn_arguments)
+        elif command.hybrid:
+            result = _run_hybrid(cast(Coroutine[Any, Any, str], command.fn(*fn_arguments)))
+        elif command.asynchronous:
+            result = _run_coroutine(cast(Awaitable[str], command.fn(*fn_arguments)))
+        elif command.body is not None:
+            result = _run_body(*command.body(*fn_arguments))
+        else:
+            result = command.fn(*fn_arguments)
+    finally:
+        if profile is not None:
+            profile.stop(command_name)
+    assert isinstance(result, str), f"Commands must return strings, got {type(result).__name__}"
+    if budget is not None:
+        budget.check_string(result)
+    return result
+
+
+def _run_hybrid(coroutine: Coroutine[Any, Any, str]) -> str:
+    # The thunks and scripts awaited by a hybrid command are evaluated
+    # synchronously here, so the coroutine finishes without suspending
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return cast(str, stop.value)
+    coroutine.close()
+    raise RuntimeError("A hybrid command awaited something other than its thunks or run_script")
+
+
+def _run_coroutine(coroutine: Awaitable[str]) -> str:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_await(coroutine))
+    # This thread is already running an event loop (a synchronous command
+    # was called by interpret_async), so the coroutine is run in another one
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, _await(coroutine)).result()
+
+
+async def _await(awaitable: Awaitable[str]) -> str:
+    return await awaitable
+
+
+def bind_arguments(context: Context, command: CommandBinding, command_name: str,
+                   arguments: Sequence[Argument]) -> List[Any]:
     fn_arguments: List[Any] = list(arguments)
     if command.contextual:
         fn_arguments.insert(0, context)
     if command.varargs:
-        last_arg_index = _max_positional_arguments(command.fn) - 1
+        last_arg_index = command.arity.max_positional - 1
         first_args = fn_arguments[:last_arg_index]
         last_args = fn_arguments[last_arg_index:]
-        if last_args:
+        if len(last_args) == 1:
+            fn_arguments = first_args + last_args
+        elif last_args:
             fn_arguments = first_args + [" ".join(last_args)]
         else:
             fn_arguments = first_args
-    if not _signature_accepts_arguments(command.fn, fn_arguments):
+    if not command.arity.accepts(len(fn_arguments)):
         raise ApplyError("Argument count does not match what command accepts",
                          command, command_name, fn_arguments)
-    result = command.fn(*fn_arguments)
-    assert isinstance(result, str), f"Commands must return strings, got {type(result).__name__}"
-    return result
-
-
-def _max_positional_arguments(fn: Callable[..., Any]) -> int:
-    sig = signature(fn)
-    max_args = 0
-    for parameter in sig.parameters.values():
-        if parameter.kind in [Parameter.POSITIONAL_ONLY,
-                              Parameter.POSITIONAL_OR_KEYWORD]:
-            max_args += 1
-    return max_args
-
-
-def _signature_accepts_arguments(fn: Callable[..., Any], arguments: List[Any]) -> bool:
-    try:
-        sig = signature(fn)
-        sig.bind(*arguments)
-        return True
-    except TypeError:
-        return False
+    return fn_arguments
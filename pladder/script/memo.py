@@ -0,0 +1,70 @@
+from sys import getsizeof
+from typing import Any, Dict, List, Sequence, Tuple
+
+from .cache import CacheStats, LruCache
+from .types import CommandFunction
+
+
+MEMO_MAX_BYTES = 4 * 1024 * 1024
+
+# Keyed on the command's function, the name it was called by (pattern
+# commands may depend on it) and the arguments. Values are the result and
+# the (approximate) memory used by the entry.
+MemoKey = Tuple[CommandFunction, str, Tuple[object, ...]]
+MemoValue = Tuple[str, int]
+
+
+class MemoStats:
+    __slots__ = ["hits", "misses"]
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def calls(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.calls if self.calls else 0.0
+
+
+def _entry_size(value: MemoValue) -> int:
+    return value[1]
+
+
+class Memo:
+    def __init__(self, max_bytes: int = MEMO_MAX_BYTES) -> None:
+        self._cache: LruCache[MemoKey, MemoValue] = LruCache(max_bytes, size_of=_entry_size)
+        self._stats: Dict[str, MemoStats] = {}
+
+    def call(self, display_name: str, fn: CommandFunction, command_name: str,
+             arguments: Sequence[object], fn_arguments: List[Any]) -> str:
+        stats = self._stats.get(display_name)
+        if stats is None:
+            stats = self._stats[display_name] = MemoStats()
+        key = (fn, command_name, tuple(arguments))
+        cached = self._cache.get(key)
+        if cached is not None:
+            stats.hits += 1
+            return cached[0]
+        stats.misses += 1
+        result = fn(*fn_arguments)
+        assert isinstance(result, str), f"Commands must return strings, got {type(result).__name__}"
+        size = getsizeof(result) + getsizeof(command_name) + sum(getsizeof(arg) for arg in arguments)
+        self._cache.put(key, (result, size))
+        return result
+
+    def command_stats(self) -> Dict[str, MemoStats]:
+        return dict(self._stats)
+
+    def cache_stats(self) -> CacheStats:
+        return self._cache.stats()
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._stats.clear()
+
+
+memo = Memo()
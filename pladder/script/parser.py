@@ -1,6 +1,8 @@
+import re
+from sys import intern
 from typing import Callable, List
 
-from .types import Call, Char, Fragment, Literal, ParseError, Variable, Word
+from .types import Call, Fragment, Literal, ParseError, Variable, Word
 
 
 def escape(word: str) -> str:
@@ -14,39 +16,48 @@ def parse(text: str) -> Call:
     return _Parser(text).parse()
 
 
+def unparse(call: Call) -> str:
+    return " ".join(unparse_word(word) for word in call.words)
+
+
+def unparse_word(word: Word) -> str:
+    parts = []
+    after_variable = False
+    for fragment in word.fragments:
+        if isinstance(fragment, Literal):
+            if fragment.string == "" or after_variable or _UNPARSE_QUOTED.search(fragment.string):
+                parts.append("{" + fragment.string + "}")
+            else:
+                parts.append(fragment.string)
+        elif isinstance(fragment, Call):
+            parts.append("[" + unparse(fragment) + "]")
+        else:
+            parts.append("$" + fragment.name)
+        after_variable = isinstance(fragment, Variable)
+    return "".join(parts)
+
+
+_UNPARSE_QUOTED = re.compile(r"[\[\]{}$ ]")
+
+
+# The parser scans with regexes that jump straight to the next character
+# that is special in the current state, instead of looking at one
+# character at a time. Literal strings and variable names are interned,
+# so the trees of many cached scripts share their common strings.
+_NOT_WHITESPACE = re.compile(r"[^ ]")
+_WORD_SPECIAL = re.compile(r"[\[\]{}$ ]")
+_BRACE = re.compile(r"[{}]")
+
+
 class _Parser:
     def __init__(self, text: str) -> None:
         self.text = text
         self.end_pos = len(text)
         self.pos = 0
 
-    def at_end(self) -> bool:
-        return self.pos == self.end_pos
-
-    def pop(self) -> Char:
-        c = self.text[self.pos]
-        self.pos += 1
-        return c
-
-    def try_pop(self, c: Char) -> bool:
-        if self.at_end():
-            return False
-        else:
-            if self.text[self.pos] == c:
-                self.pos += 1
-                return True
-            else:
-                return False
-
-    def try_peek(self, c: Char) -> bool:
-        if self.at_end():
-            return False
-        else:
-            return self.text[self.pos] == c
-
     def parse(self) -> Call:
         call = self.parse_call()
-        if self.at_end():
+        if self.pos == self.end_pos:
             return call
         else:
             raise ParseError("Excessive closing bracket")
@@ -54,73 +65,70 @@ class _Parser:
     def parse_call(self) -> Call:
         words = []
         while True:
-            self.parse_whitespace()
-            if self.at_end() or self.try_peek("]"):
+            match = _NOT_WHITESPACE.search(self.text, self.pos)
+            if match is None:
+                self.pos = self.end_pos
                 break
-            word = self.parse_word()
-            words.append(word)
-        return Call(words)
-
-    def parse_whitespace(self) -> None:
-        while True:
-            if not self.try_pop(" "):
+            self.pos = match.start()
+            if self.text[self.pos] == "]":
                 break
+            words.append(self.parse_word())
+        return Call(words)
 
     def parse_word(self) -> Word:
+        text = self.text
         fragments: List[Fragment] = []
         fragment_start = self.pos
         fragment_type: Callable[[str], Fragment] = Literal
         while True:
-            if self.at_end() or self.try_peek("]") or self.try_peek(" "):
-                fragment_end = self.pos
-                if fragment_start != fragment_end:
-                    fragment = fragment_type(self.text[fragment_start:fragment_end])
-                    fragments.append(fragment)
+            match = _WORD_SPECIAL.search(text, self.pos)
+            pos = self.end_pos if match is None else match.start()
+            c = "" if match is None else text[pos]
+            if c in ("", "]", " "):
+                if fragment_start != pos:
+                    fragments.append(fragment_type(intern(text[fragment_start:pos])))
+                self.pos = pos
                 break
-            elif self.try_pop("["):
-                fragment_end = self.pos - 1
-                if fragment_start != fragment_end:
-                    fragment = fragment_type(self.text[fragment_start:fragment_end])
-                    fragments.append(fragment)
+            elif c == "[":
+                if fragment_start != pos:
+                    fragments.append(fragment_type(intern(text[fragment_start:pos])))
+                self.pos = pos + 1
                 call = self.parse_call()
-                if self.at_end():
+                if self.pos == self.end_pos:
                     raise ParseError("Missing closing bracket")
-                else:
-                    assert self.pop() == "]"  # Should always be true
+                self.pos += 1  # Skip the closing bracket
                 fragments.append(call)
                 fragment_start = self.pos
                 fragment_type = Literal
-            elif self.try_pop("{"):
-                fragment_end = self.pos - 1
-                if fragment_start != fragment_end:
-                    fragment = Literal(self.text[fragment_start:fragment_end])
-                    fragments.append(fragment)
-                fragment_start = self.pos
-                level = 1
-                while not self.at_end():
-                    c = self.pop()
-                    if c == "{":
-                        level += 1
-                    elif c == "}":
-                        level -= 1
-                        if level == 0:
-                            break
-                if level != 0:
-                    raise ParseError("Missing closing brace")
-                fragment_end = self.pos - 1
-                fragment = Literal(self.text[fragment_start:fragment_end])
-                fragments.append(fragment)
+            elif c == "{":
+                if fragment_start != pos:
+                    fragments.append(fragment_type(intern(text[fragment_start:pos])))
+                quote_start = pos + 1
+                self.pos = self.skip_quote(quote_start)
+                fragments.append(Literal(intern(text[quote_start:self.pos - 1])))
                 fragment_start = self.pos
                 fragment_type = Literal
-            elif self.try_pop("}"):
+            elif c == "}":
                 raise ParseError("Excessive closing brace")
-            elif self.try_pop("$"):
-                fragment_end = self.pos - 1
-                if fragment_start != fragment_end:
-                    fragment = fragment_type(self.text[fragment_start:fragment_end])
-                    fragments.append(fragment)
+            else:  # c == "$"
+                if fragment_start != pos:
+                    fragments.append(fragment_type(intern(text[fragment_start:pos])))
+                self.pos = pos + 1
                 fragment_start = self.pos
                 fragment_type = Variable
-            else:
-                self.pop()
         return Word(fragments)
+
+    def skip_quote(self, pos: int) -> int:
+        # Returns the position after the brace that closes the quote
+        level = 1
+        while True:
+            match = _BRACE.search(self.text, pos)
+            if match is None:
+                raise ParseError("Missing closing brace")
+            pos = match.end()
+            if match.group() == "{":
+                level += 1
+            else:
+                level -= 1
+                if level == 0:
+                    return pos
@@ -0,0 +1,61 @@
+"""Serialization of parsed scripts, for storing them in databases.
+
+A serialized call is JSON text with the format version and the tree, in
+which a call is a list of words, a word is a list of fragments, and a
+fragment is a string (a literal), an object with the name of a variable
+or a list (a nested call). Loading a stored tree is faster than parsing
+the script again.
+"""
+
+import json
+import sys
+from typing import Any, List, Optional
+
+from .parser import parse
+from .types import Call, Fragment, Literal, Variable, Word
+
+
+FORMAT_VERSION = 1
+
+
+def serialize_call(call: Call) -> str:
+    return json.dumps({"version": FORMAT_VERSION, "call": _dump_call(call)}, separators=(",", ":"))
+
+
+def serialize_script(script: str) -> str:
+    # Raises ParseError if the script is not valid
+    return serialize_call(parse(script))
+
+
+def deserialize_call(data: str) -> Optional[Call]:
+    # Returns None if the call was serialized in another format version
+    loaded = json.loads(data)
+    if loaded.get("version") != FORMAT_VERSION:
+        return None
+    return _load_call(loaded["call"])
+
+
+def _dump_call(call: Call) -> List[Any]:
+    return [[_dump_fragment(fragment) for fragment in word.fragments] for word in call.words]
+
+
+def _dump_fragment(fragment: Fragment) -> Any:
+    if isinstance(fragment, Literal):
+        return fragment.string
+    elif isinstance(fragment, Variable):
+        return {"var": fragment.name}
+    else:
+        return _dump_call(fragment)
+
+
+def _load_call(words: List[Any]) -> Call:
+    return Call([Word([_load_fragment(fragment) for fragment in word]) for word in words])
+
+
+def _load_fragment(fragment: Any) -> Fragment:
+    if isinstance(fragment, str):
+        return Literal(sys.intern(fragment))
+    elif isinstance(fragment, dict):
+        return Variable(sys.intern(fragment["var"]))
+    else:
+        return _load_call(fragment)
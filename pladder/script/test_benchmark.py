@@ -0,0 +1,20 @@
+import pytest
+
+from .benchmark import BENCHMARKS, Result, load_results, measure_peak_bytes, save_results
+
+
+@pytest.mark.parametrize("name", list(BENCHMARKS))
+def test_benchmark_runs(name):
+    operation = BENCHMARKS[name]()
+    operation()
+
+
+def test_measure_peak_bytes():
+    assert measure_peak_bytes(lambda: lambda: bytearray(100000)) >= 100000
+
+
+def test_results_round_trip(tmp_path):
+    path = str(tmp_path / "results.json")
+    results = {"parse-short": Result(1234.5, 678)}
+    save_results(path, results)
+    assert load_results(path) == results
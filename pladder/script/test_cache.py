@@ -0,0 +1,52 @@
+from .cache import CacheStats, LruCache
+
+
+def test_get_missing():
+    cache = LruCache(2)
+    assert cache.get("a") is None
+    assert cache.stats() == CacheStats(hits=0, misses=1, evictions=0, size=0, max_size=2)
+
+
+def test_get_present():
+    cache = LruCache(2)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    assert cache.stats() == CacheStats(hits=1, misses=0, evictions=0, size=1, max_size=2)
+
+
+def test_evicts_least_recently_used():
+    cache = LruCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats().evictions == 1
+
+
+def test_replace_does_not_evict():
+    cache = LruCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 3)
+    assert cache.get("a") == 3
+    assert len(cache) == 2
+    assert cache.stats().evictions == 0
+
+
+def test_custom_size():
+    cache = LruCache(10, size_of=len)
+    cache.put("a", "xxxx")
+    cache.put("b", "xxxx")
+    cache.put("c", "xxxx")
+    assert "a" not in cache
+    assert cache.stats().size == 8
+
+
+def test_too_large_value_is_not_stored():
+    cache = LruCache(3, size_of=len)
+    cache.put("a", "xxxx")
+    assert "a" not in cache
+    assert cache.stats().size == 0
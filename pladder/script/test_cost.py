@@ -0,0 +1,56 @@
+import pytest
+
+from .cost import check_cost, estimate_applications
+from .interpreter import interpret
+from .parser import parse
+from .types import Budget, BudgetExceeded, BudgetLimits, CommandRegistry, PythonCommandGroup, command_binding, \
+    new_context
+
+
+def repeat(context, count, script):
+    return " ".join(interpret(context, script) for _ in range(int(count)))
+
+
+def repeat_cost(estimate, count, script):
+    return int(count) * estimate(script) if count is not None else estimate(script)
+
+
+def make_registry():
+    return CommandRegistry({"group": PythonCommandGroup([
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("repeat", repeat, contextual=True, cost=repeat_cost),
+    ])})
+
+
+@pytest.mark.parametrize("script, estimate", [
+    ("", 0),
+    ("echo a", 1),
+    ("echo [echo a] [echo [echo b]]", 4),
+    ("repeat 10 {echo a}", 11),
+    ("repeat 10 {repeat 100 {echo [echo a]}}", 1 + 10 * (1 + 100 * 2)),
+    # Only known at run time, so counted as one
+    ("repeat [echo 10] {echo a}", 3),
+    ("repeat 10 [echo script]", 1 + 1 + 10),
+    ("unknown-command a", 1),
+    # Left to fail when run
+    ("repeat ten {echo a}", 1),
+    ("repeat 10 {echo [}", 1),
+])
+def test_estimate(script, estimate):
+    assert estimate_applications(parse(script), make_registry()) == estimate
+
+
+def test_estimate_is_an_upper_bound_of_what_is_charged():
+    commands = make_registry()
+    script = "repeat 3 {echo [repeat 2 {echo a}]}"
+    budget = Budget()
+    interpret(new_context(commands, budget=budget), script)
+    assert budget.applications <= estimate_applications(parse(script), commands)
+
+
+def test_check_cost():
+    commands = make_registry()
+    limits = BudgetLimits(max_applications=10000)
+    check_cost(parse("repeat 10 {repeat 99 {echo a}}"), commands, limits)
+    with pytest.raises(BudgetExceeded, match="estimated to make 10011 command applications"):
+        check_cost(parse("repeat 10 {repeat 1000 {echo a}}"), commands, limits)
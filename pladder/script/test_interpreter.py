@@ -1,11 +1,16 @@
+import asyncio
 import re
+import sys
+import threading
 
 import pytest
 
-from .interpreter import interpret
+from .interpreter import compile, compile_call, eval_call, eval_compiled, fold_constants, interpret, interpret_async, \
+    parse_cache_stats, run_script
+from .parser import parse
 from .types import \
     EvalError, ApplyError, CommandRegistry, PythonCommandGroup, \
-    command_binding, new_context
+    Call, Literal, Word, command_binding, new_context
 
 
 def make_registry(*bindings):
@@ -148,3 +153,427 @@ def test_eval_contextual_regex_command():
                                              lambda context: context.command_name, contextual=True))
     result = interpret(new_context(commands), script)
     assert result == "grooooovy"
+
+
+def test_compile_reuses_parsed_script():
+    script = "upper [reverse compile-test]"
+    assert compile(script) is compile(script)
+
+
+def test_compile_counts_hits_and_misses():
+    script = "upper counting-test"
+    before = parse_cache_stats()
+    compile(script)
+    compile(script)
+    after = parse_cache_stats()
+    assert after.misses == before.misses + 1
+    assert after.hits == before.hits + 1
+
+
+def test_eval_compiled():
+    call = compile("upper [reverse foo]")
+    commands = make_registry(
+        command_binding("upper", lambda s: s.upper()),
+        command_binding("reverse", lambda s: s[::-1]),
+    )
+    result = eval_compiled(new_context(commands), call)
+    assert result == "OOF"
+
+
+def test_eval_compiled_reuses_compiled_call():
+    calls = []
+
+    def upper(s):
+        calls.append(s)
+        return s.upper()
+
+    commands = make_registry(command_binding("upper", upper, pure=True), command_binding("echo", lambda s: s))
+    call = compile("echo [upper foo]")
+    assert eval_compiled(new_context(commands), call) == "FOO"
+    assert eval_compiled(new_context(commands), call) == "FOO"
+    # Folded once, when the call was compiled
+    assert calls == ["foo"]
+    commands.new_command_group("more")
+    assert eval_compiled(new_context(commands), call) == "FOO"
+    assert calls == ["foo", "foo"]
+
+
+def test_binding_arity():
+    binding = command_binding("cmd", lambda x, y="y", *zs: x)
+    assert binding.arity.min_positional == 1
+    assert binding.arity.max_positional == 2
+    assert binding.arity.var_positional
+    assert [parameter.name for parameter in binding.arity.parameters] == ["x", "y", "zs"]
+
+
+def test_eval_contextual_too_many_args():
+    script = "ctxaware foo bar"
+    commands = make_registry(command_binding("ctxaware", lambda _context, arg: arg, contextual=True))
+    with pytest.raises(ApplyError):
+        interpret(new_context(commands), script)
+
+
+@pytest.mark.parametrize("script", [
+    "",
+    "upper foo",
+    "upper f{o}o",
+    "upper $x",
+    "upper a$x{b}[reverse c]",
+    "[echo upper] foo",
+    "u[echo pper] foo",
+    "echo [upper [reverse foo]] {} $x",
+    "if true yes no",
+    "if [echo true] [upper a] $unbound",
+    "[echo if] false $unbound [reverse $x]",
+])
+def test_compiled_matches_tree_walker(script):
+    commands = make_registry(
+        command_binding("upper", lambda s: s.upper()),
+        command_binding("reverse", lambda s: s[::-1]),
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("if", lazy_if, lazy=True),
+    )
+    call = parse(script)
+    walked_context = new_context(commands, environment={"x": "y"})
+    compiled_context = new_context(commands, environment={"x": "y"})
+    assert compile_call(call)(compiled_context) == eval_call(walked_context, call)
+    assert compiled_context.trace == walked_context.trace
+
+
+def lazy_if(condition, then_value, else_value):
+    return then_value() if condition() == "true" else else_value()
+
+
+def test_lazy_arguments_are_traced_as_source_with_their_calls_nested():
+    commands = make_registry(
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("if", lazy_if, lazy=True),
+    )
+    context = new_context(commands)
+    assert interpret(context, "if [echo true] [echo yes] {no way}") == "yes"
+    [entry] = context.trace
+    assert entry.arguments == ["[echo true]", "[echo yes]", "{no way}"]
+    assert [sub.result for sub in entry.subtrace] == ["true", "yes"]
+
+
+def test_lazy_argument_evaluated_at_most_once():
+    calls = []
+
+    def twice(value):
+        return value() + value()
+
+    def count(s):
+        calls.append(s)
+        return s
+
+    commands = make_registry(command_binding("twice", twice, lazy=True), command_binding("count", count))
+    assert interpret(new_context(commands), "twice [count a]") == "aa"
+    assert calls == ["a"]
+
+
+def test_lazy_commands_can_not_be_varargs_or_memoized():
+    with pytest.raises(ValueError):
+        command_binding("lazy", lambda value: value(), lazy=True, varargs=True)
+    with pytest.raises(ValueError):
+        command_binding("lazy", lambda value: value(), lazy=True, pure=True, memoize=True)
+
+
+def test_compiled_unbound_variable():
+    commands = make_registry(command_binding("upper", lambda s: s.upper()))
+    with pytest.raises(EvalError, match="Unbound variable: x"):
+        compile_call(parse("upper $x"))(new_context(commands))
+
+
+def test_compiled_call_sees_new_commands():
+    commands = CommandRegistry()
+    group = commands.new_command_group("group")
+    compiled = compile_call(parse("later"))
+    with pytest.raises(EvalError):
+        compiled(new_context(commands))
+    group.register_command("later", lambda: "now")
+    assert compiled(new_context(commands)) == "now"
+
+
+def test_compiled_call_used_with_another_registry():
+    compiled = compile_call(parse("cmd"))
+    first = make_registry(command_binding("cmd", lambda: "first"))
+    second = make_registry(command_binding("cmd", lambda: "second"))
+    assert compiled(new_context(first)) == "first"
+    assert compiled(new_context(second)) == "second"
+
+
+def folding_registry(calls):
+    def impure(s):
+        calls.append(s)
+        return s.upper()
+    return make_registry(
+        command_binding("upper", lambda s: s.upper(), pure=True),
+        command_binding("impure", impure),
+        command_binding("fail", lambda: 1 / 0, pure=True),
+        command_binding("echo", lambda text="": text, varargs=True, pure=True),
+        command_binding(re.compile("^na+me$"), lambda context: context.command_name, contextual=True, pure=True),
+    )
+
+
+def test_fold_pure_call_with_literal_arguments():
+    commands = folding_registry([])
+    folded = fold_constants(parse("echo [upper foo] x[naaame]"), commands)
+    assert folded == Call([Word([Literal("echo")]),
+                           Word([Literal("FOO")]),
+                           Word([Literal("x"), Literal("naaame")])])
+
+
+def test_fold_nested_pure_calls():
+    commands = folding_registry([])
+    folded = fold_constants(parse("echo [upper [echo a b]]"), commands)
+    assert folded == Call([Word([Literal("echo")]), Word([Literal("A B")])])
+
+
+def test_do_not_fold_top_level_call():
+    commands = folding_registry([])
+    assert fold_constants(parse("upper foo"), commands) == parse("upper foo")
+
+
+def test_do_not_fold_impure_variable_or_failing_calls():
+    commands = folding_registry([])
+    for script in ["echo [impure foo]", "echo [upper $x]", "echo [fail]", "echo [unknown]"]:
+        assert fold_constants(parse(script), commands) == parse(script)
+
+
+def test_interpret_folds_pure_calls_once():
+    calls = []
+    commands = folding_registry(calls)
+    script = "echo [upper folding-test] [impure folding-test]"
+    for _ in range(3):
+        assert interpret(new_context(commands), script) == "FOLDING-TEST FOLDING-TEST"
+    assert calls == ["folding-test"] * 3
+
+
+def test_interpret_refolds_when_commands_change():
+    commands = CommandRegistry()
+    group = commands.new_command_group("group")
+    group.register_command("echo", lambda text="": text, varargs=True, pure=True)
+    group.register_command("value", lambda: "old", pure=True)
+    script = "echo [value] refold-test"
+    assert interpret(new_context(commands), script) == "old refold-test"
+    group.remove_command("value")
+    group.register_command("value", lambda: "new", pure=True)
+    assert interpret(new_context(commands), script) == "new refold-test"
+
+
+def concurrent_registry(parties):
+    barrier = threading.Barrier(parties, timeout=5)
+
+    def wait(s):
+        barrier.wait()
+        return s
+
+    return make_registry(
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("wait", wait, concurrent=True),
+        command_binding("fail", lambda s: 1 / 0, concurrent=True),
+        command_binding("thread", lambda: threading.current_thread().name),
+    )
+
+
+def test_sibling_concurrent_calls_run_concurrently():
+    commands = concurrent_registry(3)
+    context = new_context(commands, environment={"x": "b"})
+    assert interpret(context, "echo [wait a] [echo between] [wait $x] [wait c]") == "a between b c"
+    assert [(entry.command_name, entry.arguments, entry.result) for entry in context.trace] == [
+        ("wait", ["a"], "a"),
+        ("echo", ["between"], "between"),
+        ("wait", ["b"], "b"),
+        ("wait", ["c"], "c"),
+        ("echo", ["a", "between", "b", "c"], "a between b c"),
+    ]
+
+
+def test_failing_concurrent_call():
+    commands = concurrent_registry(1)
+    context = new_context(commands)
+    with pytest.raises(ZeroDivisionError):
+        interpret(context, "echo [wait a] [fail b] [wait c]")
+    assert [(entry.command_name, type(entry.result)) for entry in context.trace] == \
+        [("wait", str), ("fail", ZeroDivisionError)]
+
+
+def test_other_commands_are_not_run_concurrently():
+    commands = concurrent_registry(1)
+    assert interpret(new_context(commands), "echo [thread] [thread]") == "MainThread MainThread"
+
+
+def test_concurrent_commands_can_not_be_contextual():
+    with pytest.raises(ValueError):
+        command_binding("io", lambda context: "", contextual=True, concurrent=True)
+
+
+def tail_registry(base_case="echo done", with_body=True):
+    def countdown_body(context, n):
+        if n == "0":
+            return context, base_case
+        return context._replace(environment={"n": str(int(n) - 1)}), "countdown $n"
+
+    def dispatch_body(context, n):
+        # Calls itself by a command name that is only known at run time
+        next_command = "echo" if n == "0" else "dispatch"
+        return context._replace(environment={"next": next_command, "n": str(int(n) - 1)}), "$next $n"
+
+    return make_registry(
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("countdown", lambda context, n: interpret(*countdown_body(context, n)),
+                        contextual=True, body=countdown_body if with_body else None),
+        command_binding("dispatch", lambda context, n: interpret(*dispatch_body(context, n)),
+                        contextual=True, body=dispatch_body),
+    )
+
+
+def trace_shape(trace):
+    return [(entry.command_name, entry.result if isinstance(entry.result, str) else type(entry.result),
+             trace_shape(entry.subtrace))
+            for entry in trace]
+
+
+@pytest.mark.parametrize("evaluate", [interpret, lambda context, script: eval_call(context, parse(script))])
+def test_tail_calls_run_in_constant_stack(evaluate):
+    depth = sys.getrecursionlimit() * 2
+    commands = tail_registry()
+    assert evaluate(new_context(commands), f"countdown {depth}") == "done"
+    assert evaluate(new_context(commands), f"dispatch {depth}") == "-1"
+
+
+def test_tail_calls_are_traced_like_other_calls():
+    context = new_context(tail_registry())
+    interpret(context, "countdown 3")
+    recursive_context = new_context(tail_registry(with_body=False))
+    interpret(recursive_context, "countdown 3")
+    assert trace_shape(context.trace) == trace_shape(recursive_context.trace)
+    assert len(trace_shape(context.trace)[0][2][0][2][0][2]) == 1
+
+
+def test_failing_tail_call_fails_every_caller():
+    context = new_context(tail_registry(base_case="no-such-command"))
+    with pytest.raises(EvalError):
+        interpret(context, "countdown 2")
+    assert trace_shape(context.trace) == [("countdown", EvalError, [("countdown", EvalError, [
+        ("countdown", EvalError, [])])])]
+
+
+def async_registry():
+    events = {}
+
+    def event(name):
+        return events.setdefault(name, asyncio.Event())
+
+    async def signal(name):
+        event(name).set()
+        return name
+
+    async def wait_for(name):
+        await event(name).wait()
+        return name
+
+    async def upper(s):
+        await asyncio.sleep(0)
+        return s.upper()
+
+    def countdown_body(context, n):
+        if n == "0":
+            return context, "upper done"
+        return context._replace(environment={"n": str(int(n) - 1)}), "countdown $n"
+
+    async def hybrid_if(condition, then_value, else_value):
+        return await then_value if await condition == "true" else await else_value
+
+    async def hybrid_eval(context, script):
+        return await run_script(context, script)
+
+    return make_registry(
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("signal", signal),
+        command_binding("wait-for", wait_for),
+        command_binding("upper", upper),
+        command_binding("eval", lambda context, script: interpret(context, script), contextual=True),
+        command_binding("if", hybrid_if, lazy=True, hybrid=True),
+        command_binding("hybrid-eval", hybrid_eval, contextual=True, hybrid=True),
+        command_binding("countdown", lambda context, n: interpret(*countdown_body(context, n)),
+                        contextual=True, body=countdown_body),
+    )
+
+
+def run_async(*coroutines):
+    async def run_all():
+        return await asyncio.wait_for(asyncio.gather(*coroutines), timeout=5)
+    return asyncio.run(run_all())
+
+
+def test_interpret_async_awaits_async_commands():
+    commands = async_registry()
+    context = new_context(commands, environment={"x": "foo"})
+    assert run_async(interpret_async(context, "echo [upper $x] bar")) == ["FOO bar"]
+    assert [entry.command_name for entry in context.trace] == ["upper", "echo"]
+
+
+def test_interpret_async_has_many_scripts_in_flight():
+    commands = async_registry()
+    results = run_async(interpret_async(new_context(commands), "echo [wait-for a] [signal b]"),
+                        interpret_async(new_context(commands), "echo [signal a] [wait-for b]"))
+    assert results == ["a b", "a b"]
+
+
+def test_interpret_async_evaluates_bodies_asynchronously():
+    commands = async_registry()
+    context = new_context(commands)
+    assert run_async(interpret_async(context, "countdown 3")) == ["DONE"]
+    assert context.trace == interpret_trace(commands, "countdown 3")
+
+
+def interpret_trace(commands, script):
+    context = new_context(commands)
+    interpret(context, script)
+    return context.trace
+
+
+def test_async_commands_work_in_synchronous_evaluation():
+    commands = async_registry()
+    assert interpret(new_context(commands), "echo [upper foo]") == "FOO"
+    assert run_async(interpret_async(new_context(commands), "eval {upper bar}")) == ["BAR"]
+
+
+def test_interpret_async_awaits_lazy_arguments_of_hybrid_commands():
+    commands = async_registry()
+    results = run_async(interpret_async(new_context(commands), "if [echo true] [wait-for a] [upper x]"),
+                        interpret_async(new_context(commands), "if [signal a] [upper y] [wait-for b]"),
+                        interpret_async(new_context(commands), "if [echo false] [upper z] [signal b]"))
+    assert results == ["a", "b", "b"]
+
+
+def test_interpret_async_awaits_scripts_run_by_hybrid_commands():
+    commands = async_registry()
+    results = run_async(interpret_async(new_context(commands), "hybrid-eval {echo [wait-for a]}"),
+                        interpret_async(new_context(commands), "hybrid-eval {hybrid-eval {signal a}}"))
+    assert results == ["a", "a"]
+
+
+def test_hybrid_commands_in_synchronous_evaluation():
+    commands = async_registry()
+    script = "hybrid-eval {if [echo true] [upper x] [no-such-command]}"
+    context = new_context(commands)
+    assert interpret(context, script) == "X"
+    async_context = new_context(commands)
+    assert run_async(interpret_async(async_context, script)) == ["X"]
+    assert async_context.trace == context.trace
+    # Also when a synchronous command runs the script under interpret_async
+    assert run_async(interpret_async(new_context(commands), f"eval {{{script}}}")) == ["X"]
+
+
+def test_hybrid_commands_must_only_await_thunks_and_scripts():
+    async def sleepy():
+        await asyncio.sleep(0)
+        return ""
+
+    commands = make_registry(command_binding("sleepy", sleepy, hybrid=True))
+    with pytest.raises(RuntimeError, match="hybrid command"):
+        interpret(new_context(commands), "sleepy")
+    with pytest.raises(ValueError, match="coroutine functions"):
+        command_binding("not-async", lambda: "", hybrid=True)
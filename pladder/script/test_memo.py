@@ -0,0 +1,56 @@
+from .interpreter import interpret
+from .memo import Memo
+from .types import CommandRegistry, command_binding, new_context
+
+import pytest
+
+
+def counting(calls):
+    def fn(text):
+        calls.append(text)
+        return text.upper()
+    return fn
+
+
+def test_memo_calls_once_per_arguments():
+    calls = []
+    memo = Memo()
+    fn = counting(calls)
+    assert memo.call("upper", fn, "upper", ["a"], ["a"]) == "A"
+    assert memo.call("upper", fn, "upper", ["a"], ["a"]) == "A"
+    assert memo.call("upper", fn, "upper", ["b"], ["b"]) == "B"
+    assert calls == ["a", "b"]
+    stats = memo.command_stats()["upper"]
+    assert (stats.hits, stats.misses) == (1, 2)
+
+
+def test_memo_key_includes_command_name():
+    memo = Memo()
+    fn = lambda context: context  # noqa: E731
+    assert memo.call("/na+me/", fn, "name", [], ["name"]) == "name"
+    assert memo.call("/na+me/", fn, "naame", [], ["naame"]) == "naame"
+
+
+def test_memo_bounded_by_bytes():
+    memo = Memo(max_bytes=1000)
+    fn = counting([])
+    for i in range(100):
+        memo.call("upper", fn, "upper", [str(i)], [str(i)])
+    stats = memo.cache_stats()
+    assert stats.size <= 1000
+    assert stats.evictions > 0
+
+
+def test_memoized_command():
+    calls = []
+    commands = CommandRegistry()
+    group = commands.new_command_group("group")
+    group.register_command("memo-upper", counting(calls), pure=True, memoize=True)
+    for _ in range(3):
+        assert interpret(new_context(commands), "memo-upper memoized-command") == "MEMOIZED-COMMAND"
+    assert calls == ["memoized-command"]
+
+
+def test_only_pure_commands_can_be_memoized():
+    with pytest.raises(ValueError):
+        command_binding("foo", lambda: "", memoize=True)
@@ -1,7 +1,10 @@
+import random
+from typing import Callable, List
+
 import pytest
 
-from .parser import parse
-from .types import ParseError, Call, Word, Literal, Variable
+from .parser import parse, unparse
+from .types import ParseError, Call, Char, Fragment, Word, Literal, Variable
 
 
 def call(*words):
@@ -166,3 +169,161 @@ def test_adjacient_variables():
     assert invocation == call(word(literal("cmd")),
                               word(variable("foo"),
                                    variable("bar")))
+
+
+# The original character-by-character parser (with variables before quotes
+# fixed). It is kept as a reference to check that the scanning parser builds
+# exactly the same trees and fails with the same errors.
+class _ReferenceParser:
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.end_pos = len(text)
+        self.pos = 0
+
+    def at_end(self) -> bool:
+        return self.pos == self.end_pos
+
+    def pop(self) -> Char:
+        c = self.text[self.pos]
+        self.pos += 1
+        return c
+
+    def try_pop(self, c: Char) -> bool:
+        if self.at_end():
+            return False
+        else:
+            if self.text[self.pos] == c:
+                self.pos += 1
+                return True
+            else:
+                return False
+
+    def try_peek(self, c: Char) -> bool:
+        if self.at_end():
+            return False
+        else:
+            return self.text[self.pos] == c
+
+    def parse(self) -> Call:
+        call = self.parse_call()
+        if self.at_end():
+            return call
+        else:
+            raise ParseError("Excessive closing bracket")
+
+    def parse_call(self) -> Call:
+        words = []
+        while True:
+            self.parse_whitespace()
+            if self.at_end() or self.try_peek("]"):
+                break
+            word = self.parse_word()
+            words.append(word)
+        return Call(words)
+
+    def parse_whitespace(self) -> None:
+        while True:
+            if not self.try_pop(" "):
+                break
+
+    def parse_word(self) -> Word:
+        fragments: List[Fragment] = []
+        fragment_start = self.pos
+        fragment_type: Callable[[str], Fragment] = Literal
+        while True:
+            if self.at_end() or self.try_peek("]") or self.try_peek(" "):
+                fragment_end = self.pos
+                if fragment_start != fragment_end:
+                    fragment = fragment_type(self.text[fragment_start:fragment_end])
+                    fragments.append(fragment)
+                break
+            elif self.try_pop("["):
+                fragment_end = self.pos - 1
+                if fragment_start != fragment_end:
+                    fragment = fragment_type(self.text[fragment_start:fragment_end])
+                    fragments.append(fragment)
+                call = self.parse_call()
+                if self.at_end():
+                    raise ParseError("Missing closing bracket")
+                else:
+                    assert self.pop() == "]"  # Should always be true
+                fragments.append(call)
+                fragment_start = self.pos
+                fragment_type = Literal
+            elif self.try_pop("{"):
+                fragment_end = self.pos - 1
+                if fragment_start != fragment_end:
+                    fragment = fragment_type(self.text[fragment_start:fragment_end])
+                    fragments.append(fragment)
+                fragment_start = self.pos
+                level = 1
+                while not self.at_end():
+                    c = self.pop()
+                    if c == "{":
+                        level += 1
+                    elif c == "}":
+                        level -= 1
+                        if level == 0:
+                            break
+                if level != 0:
+                    raise ParseError("Missing closing brace")
+                fragment_end = self.pos - 1
+                fragment = Literal(self.text[fragment_start:fragment_end])
+                fragments.append(fragment)
+                fragment_start = self.pos
+                fragment_type = Literal
+            elif self.try_pop("}"):
+                raise ParseError("Excessive closing brace")
+            elif self.try_pop("$"):
+                fragment_end = self.pos - 1
+                if fragment_start != fragment_end:
+                    fragment = fragment_type(self.text[fragment_start:fragment_end])
+                    fragments.append(fragment)
+                fragment_start = self.pos
+                fragment_type = Variable
+            else:
+                self.pop()
+        return Word(fragments)
+
+
+def parse_or_error(parser, text):
+    try:
+        return parser(text)
+    except ParseError as e:
+        return e.args
+
+
+FUZZ_ALPHABET = "ab $[]{}"
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_parse_same_as_reference(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        text = "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randrange(30)))
+        expected = parse_or_error(lambda text: _ReferenceParser(text).parse(), text)
+        assert parse_or_error(parse, text) == expected, text
+
+
+def test_parse_quirks_same_as_reference():
+    for text in ["$", "a$", "$$", "$a{b}", "$a[b]c", "{}", "{{}}x", "[]", " [ ] ", "a]", "}", "{", "[", "a$b$c"]:
+        expected = parse_or_error(lambda text: _ReferenceParser(text).parse(), text)
+        assert parse_or_error(parse, text) == expected, text
+
+
+@pytest.mark.parametrize("text", [
+    "cmd",
+    "cmd arg1 {two words} {}",
+    "cmd [sub $x]y[sub2] prefix$var",
+    "cmd {[not a call]} {$not a var}",
+    "cmd $var{quoted} $a$b",
+])
+def test_unparse_round_trip(text):
+    assert parse(unparse(parse(text))) == parse(text)
+
+
+def test_literals_and_variable_names_are_interned():
+    first = parse("cmd some-word $some_var")
+    second = parse("other some-word $some_var")
+    assert first.words[1].fragments[0].string is second.words[1].fragments[0].string
+    assert first.words[2].fragments[0].name is second.words[2].fragments[0].name
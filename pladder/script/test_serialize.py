@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from .parser import parse
+from .serialize import FORMAT_VERSION, deserialize_call, serialize_call, serialize_script
+from .types import ParseError
+
+
+@pytest.mark.parametrize("script", [
+    "",
+    "cmd",
+    "cmd arg1 {two words} {}",
+    "cmd [sub $x]y[sub2 [sub3]] prefix$var",
+    "cmd {[not a call]} {$not a var} {\"quoted\"}",
+])
+def test_round_trip(script):
+    assert deserialize_call(serialize_call(parse(script))) == parse(script)
+
+
+def test_other_format_version_is_not_loaded():
+    data = json.loads(serialize_script("cmd"))
+    data["version"] = FORMAT_VERSION + 1
+    assert deserialize_call(json.dumps(data)) is None
+
+
+def test_invalid_script():
+    with pytest.raises(ParseError):
+        serialize_script("cmd [")
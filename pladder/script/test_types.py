@@ -0,0 +1,246 @@
+import re
+
+import pytest
+
+from .types import BoundedTrace, Call, CallSite, CommandGroup, CommandRegistry, Environment, Literal, NoTrace, \
+    Profile, PythonCommandGroup, Scope, ScriptError, Trace, Variable, Word, command_binding, new_context
+
+
+class DynamicGroup(CommandGroup):
+    def __init__(self, names):
+        self.names = names
+
+    def lookup_command(self, command_name):
+        if command_name in self.names:
+            return command_binding(command_name, lambda: "dynamic", source="dynamic")
+        return None
+
+    def list_commands(self):
+        return list(self.names)
+
+
+def result_of(commands, command_name):
+    command = commands.lookup_command(command_name)
+    return None if command is None else command.fn()
+
+
+def test_lookup_exact_name():
+    commands = CommandRegistry()
+    group = commands.new_command_group("a")
+    group.register_command("foo", lambda: "foo")
+    group.register_command("bar", lambda: "bar")
+    assert result_of(commands, "bar") == "bar"
+    assert result_of(commands, "baz") is None
+
+
+def test_first_group_wins():
+    commands = CommandRegistry()
+    commands.new_command_group("a").register_command("foo", lambda: "a")
+    commands.new_command_group("b").register_command("foo", lambda: "b")
+    assert result_of(commands, "foo") == "a"
+
+
+def test_first_binding_in_group_wins():
+    group = PythonCommandGroup()
+    group.register_command("foo", lambda: "first")
+    group.register_command("foo", lambda: "second")
+    assert group.lookup_command("foo").fn() == "first"
+
+
+def test_earlier_pattern_shadows_exact_name():
+    group = PythonCommandGroup()
+    group.register_command(re.compile("^fo+$"), lambda: "pattern")
+    group.register_command("foo", lambda: "exact")
+    assert group.lookup_command("foo").fn() == "pattern"
+
+
+def test_later_pattern_does_not_shadow_exact_name():
+    group = PythonCommandGroup()
+    group.register_command("foo", lambda: "exact")
+    group.register_command(re.compile("^fo+$"), lambda: "pattern")
+    assert group.lookup_command("foo").fn() == "exact"
+    assert group.lookup_command("fooo").fn() == "pattern"
+
+
+def test_pattern_in_earlier_group_shadows_exact_name():
+    commands = CommandRegistry()
+    commands.new_command_group("a").register_command(re.compile("^fo+$"), lambda: "a")
+    commands.new_command_group("b").register_command("foo", lambda: "b")
+    assert result_of(commands, "foo") == "a"
+
+
+def test_dynamic_group_precedence():
+    commands = CommandRegistry()
+    commands.add_command_group("dynamic", DynamicGroup(["foo"]))
+    commands.new_command_group("python").register_command("foo", lambda: "python")
+    commands.add_command_group("late", DynamicGroup(["bar"]))
+    assert result_of(commands, "foo") == "dynamic"
+    assert result_of(commands, "bar") == "dynamic"
+
+
+def test_register_after_lookup():
+    commands = CommandRegistry()
+    group = commands.new_command_group("a")
+    assert result_of(commands, "foo") is None
+    group.register_command("foo", lambda: "foo")
+    assert result_of(commands, "foo") == "foo"
+
+
+def test_remove_reveals_next_binding():
+    commands = CommandRegistry()
+    group_a = commands.new_command_group("a")
+    group_a.register_command("foo", lambda: "a")
+    commands.new_command_group("b").register_command("foo", lambda: "b")
+    assert result_of(commands, "foo") == "a"
+    group_a.remove_command("foo")
+    assert result_of(commands, "foo") == "b"
+
+
+def test_remove_unknown_command():
+    group = PythonCommandGroup()
+    with pytest.raises(ScriptError):
+        group.remove_command("foo")
+
+
+def test_lookup_group():
+    commands = CommandRegistry()
+    group = commands.new_command_group("a")
+    assert commands.lookup_group("a") is group
+    assert commands.lookup_group("b") is None
+
+
+def test_first_matching_pattern_wins():
+    group = PythonCommandGroup()
+    group.register_command(re.compile("^kloo+fify$"), lambda: "kloofify")
+    group.register_command(re.compile("^k.*$"), lambda: "catch-all")
+    group.register_command(re.compile("^klooofify$"), lambda: "never")
+    assert group.lookup_command("klooofify").fn() == "kloofify"
+    assert group.lookup_command("kaka").fn() == "catch-all"
+    assert group.lookup_command("vrålify") is None
+
+
+def test_pattern_registered_after_lookup():
+    group = PythonCommandGroup()
+    group.register_command(re.compile("^a+$"), lambda: "a")
+    assert group.lookup_command("bb") is None
+    group.register_command(re.compile("^b+$"), lambda: "b")
+    assert group.lookup_command("bb").fn() == "b"
+
+
+def test_pattern_flags_are_kept():
+    group = PythonCommandGroup()
+    group.register_command(re.compile("^vrå*lify$", re.IGNORECASE), lambda: "vrål")
+    group.register_command(re.compile("^VR"), lambda: "other")
+    assert group.lookup_command("VRÅÅLIFY").fn() == "vrål"
+
+
+def test_patterns_with_groups():
+    group = PythonCommandGroup()
+    group.register_command(re.compile("^(x)\\1$"), lambda: "xx")
+    group.register_command(re.compile("^y+$"), lambda: "y")
+    assert group.lookup_command("xx").fn() == "xx"
+    assert group.lookup_command("xy") is None
+    assert group.lookup_command("yy").fn() == "y"
+
+
+def run_traced(trace, script):
+    from .interpreter import interpret
+    commands = CommandRegistry()
+    group = commands.new_command_group("a")
+    group.register_command("echo", lambda text="": text, varargs=True)
+    group.register_command("eval", interpret, contextual=True)
+    context = new_context(commands, trace=trace)
+    interpret(context, script)
+    return context.trace
+
+
+def test_full_trace():
+    trace = run_traced(Trace(), "eval {eval {echo a}}")
+    assert [entry.command_name for entry in trace] == ["eval"]
+    assert [entry.command_name for entry in trace[0].subtrace] == ["eval"]
+    assert [entry.command_name for entry in trace[0].subtrace[0].subtrace] == ["echo"]
+    assert not trace.truncated
+
+
+def test_no_trace():
+    trace = run_traced(NoTrace(), "eval {eval {echo a}}")
+    assert list(trace) == []
+
+
+def test_bounded_trace_keeps_last_entries():
+    trace = run_traced(BoundedTrace(max_entries=2, max_depth=5), "echo [echo 1] [echo 2] [echo 3]")
+    assert [entry.result for entry in trace] == ["3", "1 2 3"]
+    assert trace.truncated
+
+
+def test_bounded_trace_max_depth():
+    trace = run_traced(BoundedTrace(max_entries=10, max_depth=2), "eval {eval {echo a}}")
+    assert len(trace[0].subtrace) == 1
+    assert len(trace[0].subtrace[0].subtrace) == 0
+    assert trace.truncated
+
+
+def test_bounded_trace_within_limits():
+    trace = run_traced(BoundedTrace(max_entries=10, max_depth=3), "eval {eval {echo a}}")
+    assert len(trace[0].subtrace[0].subtrace) == 1
+    assert not trace.truncated
+
+
+def test_scope_lookup_shadows_parent():
+    scope = Scope({"x": "inner"}, Scope({"x": "outer", "y": "y"}, {"z": "z"}))
+    assert (scope["x"], scope["y"], scope["z"]) == ("inner", "y", "z")
+    assert dict(scope) == {"x": "inner", "y": "y", "z": "z"}
+    assert len(scope) == 3
+    with pytest.raises(KeyError):
+        scope["missing"]
+
+
+def test_deep_scope_chain_is_flattened():
+    scope: Environment = {"v0": "0"}
+    for i in range(1, 3 * Scope.MAX_DEPTH):
+        scope = Scope({f"v{i}": str(i)}, scope)
+    assert scope._depth <= Scope.MAX_DEPTH
+    assert [scope[f"v{i}"] for i in range(3 * Scope.MAX_DEPTH)] == [str(i) for i in range(3 * Scope.MAX_DEPTH)]
+
+
+def test_nodes_compare_by_type_and_value():
+    assert Call([Word([Literal("a")])]) == Call((Word((Literal("a"),)),))
+    assert Literal("a") != Variable("a")
+    assert hash(Word([Variable("x")])) == hash(Word((Variable("x"),)))
+    assert repr(Word([Literal("a")])) == "Word(fragments=(Literal(string='a'),))"
+
+
+def test_profile_self_and_total_time():
+    ticks = iter(range(0, 1000, 10))
+    profile = Profile(clock=lambda: next(ticks))
+    profile.start("outer")     # 0
+    profile.start("inner")     # 10
+    profile.start("inner")     # 20
+    profile.stop("inner")      # 30
+    profile.stop("inner")      # 40
+    profile.stop("outer")      # 50
+    outer, inner = profile.entries["outer"], profile.entries["inner"]
+    assert (outer.calls, outer.total_ns, outer.self_ns) == (1, 50, 20)
+    # The recursive call is included in the time of the outermost one
+    assert (inner.calls, inner.total_ns, inner.self_ns) == (2, 30, 30)
+
+
+def test_call_site_caches_lookup_per_generation_and_name():
+    group = DynamicGroup(["a", "b"])
+    lookups = []
+    lookup_command = group.lookup_command
+    group.lookup_command = lambda name: lookups.append(name) or lookup_command(name)
+    commands = CommandRegistry({"dynamic": group})
+    site = CallSite()
+    assert site.lookup(commands, "a") is site.lookup(commands, "a")
+    assert site.lookup(commands, "b").display_name == "b"
+    commands.commands_changed()
+    site.lookup(commands, "b")
+    assert lookups == ["a", "b", "b"]
+
+
+def test_call_site_is_not_part_of_call_value():
+    call = Call([Word([Literal("a")])])
+    call.call_site = CallSite()
+    assert call == Call([Word([Literal("a")])])
+    assert repr(call) == "Call(words=(Word(fragments=(Literal(string='a'),)),))"
@@ -0,0 +1,58 @@
+from pytest import raises
+
+from .types import ScriptError
+from .values import ListValue, list_items, make_list, parse_list
+
+
+def test_make_list_quotes_items():
+    value = make_list(["a", "b c", "", "{d}", "$e"])
+    assert value == "a {b c} {} {{d}} {$e}"
+    assert value.items == ("a", "b c", "", "{d}", "$e")
+
+
+def test_parse_list_of_rendering():
+    assert parse_list("a {b c} {} {{d}} {$e}") == ("a", "b c", "", "{d}", "$e")
+    assert parse_list("  a   b ") == ("a", "b")
+    assert parse_list("a} b") == ("a}", "b")
+    assert parse_list("a{b c") == ("a{b", "c")
+
+
+def test_parse_list_missing_brace():
+    with raises(ScriptError, match="Missing closing brace"):
+        parse_list("a {b")
+
+
+def test_list_items_does_not_parse_list_values():
+    value = make_list(["x y"])
+    value.items = ("not parsed",)
+    assert list_items(value) == ("not parsed",)
+    assert list_items("x y") == ("x", "y")
+
+
+def test_list_value_coerces_to_its_rendering():
+    value = make_list(["a", "b c"])
+    assert isinstance(value, str)
+    assert value + "!" == "a {b c}!"
+    assert type(str(value)) is str
+    assert type(value[:]) is str
+    assert not isinstance(value.upper(), ListValue)
+
+
+def test_items_with_unmatched_braces():
+    items = ("hej", ":{", "a} b", "\\o/", "{ \\", "x\\")
+    value = make_list(items)
+    assert value == "hej :\\{ a\\}\\ b {\\o/} \\{\\ \\\\ {x\\}"
+    assert parse_list(value) == items
+
+
+def test_parse_list_backslashes():
+    assert parse_list("a\\ b c") == ("a b", "c")
+    assert parse_list("\\{ \\} \\\\") == ("{", "}", "\\")
+    assert parse_list("{a\\} b\\") == ("a\\", "b\\")
+    # Other backslashes are kept
+    assert parse_list("\\o/ C:\\dir") == ("\\o/", "C:\\dir")
+
+
+def test_plain_string_with_backslash_is_parsed_as_split_makes_it():
+    text = "\\o/ yay"
+    assert list_items(text) == list_items(make_list(text.split(" "))) == ("\\o/", "yay")
@@ -0,0 +1,141 @@
+import sys
+
+import pytest
+
+from .interpreter import eval_call, interpret
+from .parser import parse
+from .types import ApplyError, CommandGroup, CommandRegistry, EvalError, Profile, PythonCommandGroup, command_binding, \
+    new_context
+from .vm import run
+
+
+def countdown_body(context, n):
+    if n == "0":
+        return context, "echo done"
+    else:
+        return context._replace(environment={"n": str(int(n) - 1)}), "countdown $n"
+
+
+def nest_body(context, n):
+    # Not a tail call: the result of the recursive call is used by echo
+    if n == "0":
+        return context, "echo done"
+    else:
+        return context._replace(environment={"n": str(int(n) - 1)}), "echo [nest $n]"
+
+
+def make_registry(*bindings):
+    return CommandRegistry({"group": PythonCommandGroup([
+        command_binding("upper", lambda s: s.upper()),
+        command_binding("reverse", lambda s: s[::-1]),
+        command_binding("echo", lambda text="": text, varargs=True),
+        command_binding("countdown", lambda context, n: interpret(*countdown_body(context, n)),
+                        contextual=True, body=countdown_body),
+        command_binding("nest", lambda context, n: interpret(*nest_body(context, n)),
+                        contextual=True, body=nest_body),
+        command_binding("fail", lambda: interpret(None, "no")),
+        command_binding("if", lambda c, t, e: t() if c() == "true" else e(), lazy=True),
+    ] + list(bindings))})
+
+
+@pytest.mark.parametrize("script", [
+    "",
+    "upper foo",
+    "upper f{o}o",
+    "upper a$x{b}[reverse c]",
+    "[echo upper] foo",
+    "echo [upper [reverse foo]] {} $x",
+    "countdown 3",
+    "if true yes no",
+    "if [echo false] $unbound [upper [reverse a$x]]",
+    "[echo if] [echo true] [countdown 2] [fail]",
+    "echo [if true [upper a] b] c",
+])
+def test_same_result_as_interpret(script):
+    commands = make_registry()
+    vm_context = new_context(commands, environment={"x": "y"})
+    interpret_context = new_context(commands, environment={"x": "y"})
+    assert run(vm_context, script) == interpret(interpret_context, script)
+    assert vm_context.trace == interpret_context.trace
+
+
+@pytest.mark.parametrize("evaluate", [interpret, run])
+def test_profile_counts_calls(evaluate):
+    profile = Profile()
+    context = new_context(make_registry(), environment={"x": "abc"}, profile=profile)
+    assert evaluate(context, "echo [countdown 3] [upper $x]") == "done ABC"
+    calls = {name: entry.calls for name, entry in profile.entries.items()}
+    assert calls == {"countdown": 4, "echo": 2, "upper": 1}
+    assert profile.entries["countdown"].total_ns >= profile.entries["countdown"].self_ns
+
+
+class CountingGroup(CommandGroup):
+    # Like the alias and userdef groups, where each lookup is a query
+    def __init__(self):
+        self.lookups = 0
+
+    def lookup_command(self, command_name):
+        self.lookups += 1
+        if command_name == "dyn":
+            return command_binding("dyn", lambda text: text.upper(), varargs=True)
+        return None
+
+    def list_commands(self):
+        return ["dyn"]
+
+
+def walk(context, script, call=parse("dyn [dyn a] $x")):
+    return eval_call(context, call)
+
+
+@pytest.mark.parametrize("evaluate", [walk, interpret, run])
+def test_call_sites_cache_lookups_until_commands_change(evaluate):
+    group = CountingGroup()
+    commands = CommandRegistry({"counting": group})
+    script = "dyn [dyn a] $x"
+    assert evaluate(new_context(commands, environment={"x": "x"}), script) == "A X"
+    first_lookups = group.lookups
+    assert evaluate(new_context(commands, environment={"x": "y"}), script) == "A Y"
+    assert group.lookups == first_lookups
+    commands.commands_changed()
+    evaluate(new_context(commands, environment={"x": "z"}), script)
+    assert group.lookups == 2 * first_lookups
+
+
+def test_unknown_command():
+    with pytest.raises(EvalError, match="Unknown command name: foo"):
+        run(new_context(make_registry()), "foo")
+
+
+def test_unbound_variable():
+    with pytest.raises(EvalError, match="Unbound variable: x"):
+        run(new_context(make_registry()), "upper $x")
+
+
+def test_wrong_argument_count_for_body_command():
+    with pytest.raises(ApplyError):
+        run(new_context(make_registry()), "countdown 1 2")
+
+
+def test_deeper_than_python_recursion_limit():
+    depth = sys.getrecursionlimit() * 2
+    result = run(new_context(make_registry()), f"countdown {depth}", max_depth=depth + 2)
+    assert result == "done"
+
+
+def test_max_depth():
+    context = new_context(make_registry())
+    with pytest.raises(EvalError, match="Maximum nesting depth exceeded"):
+        run(context, "nest 10", max_depth=5)
+    entry = context.trace[0]
+    assert entry.command_name == "nest"
+    assert isinstance(entry.result, EvalError)
+
+
+def test_tail_calls_do_not_count_towards_max_depth():
+    commands = make_registry()
+    context = new_context(commands)
+    assert run(context, "countdown 100", max_depth=2) == "done"
+    interpreted_context = new_context(commands)
+    interpret(interpreted_context, "countdown 100")
+    assert context.trace == interpreted_context.trace
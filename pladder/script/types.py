@@ -1,6 +1,10 @@
-from inspect import getsource
+from inspect import Parameter, getsource, iscoroutinefunction, signature
+from itertools import count
 import re
-from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Pattern, Union
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Pattern, \
+    Tuple, Union
 
 
 class ScriptError(Exception):
@@ -15,43 +19,168 @@ class EvalError(ScriptError):
     pass
 
 
-class Call(NamedTuple):
-    # Actually this should be List[Word], but mypy does not support recursive types.
-    words: List[Any]
+class Node:
+    # Base class of the syntax tree nodes. Nodes keep their children in
+    # tuples, have no instance dicts and are compared by value (of their
+    # _fields). They are never changed after they have been created.
+    __slots__: Tuple[str, ...] = ()
+    _fields: Tuple[str, ...] = ()
 
+    def _values(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self._fields)
 
-class Literal(NamedTuple):
-    string: str
+    def __eq__(self, other: object) -> bool:
+        return type(other) is type(self) and isinstance(other, Node) and self._values() == other._values()
 
+    def __hash__(self) -> int:
+        return hash((type(self), self._values()))
 
-class Variable(NamedTuple):
-    name: str
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={value!r}" for name, value in zip(self._fields, self._values()))
+        return f"{type(self).__name__}({fields})"
+
+
+class Call(Node):
+    _fields = ("words",)
+    # The call site and the compiled call (and the registry generation it
+    # was compiled for) are inline caches used by evaluators, not part of
+    # the value of the call
+    __slots__ = ("words", "call_site", "compiled")
+
+    def __init__(self, words: Iterable["Word"]) -> None:
+        self.words = tuple(words)
+        self.call_site: Optional[CallSite] = None
+        self.compiled: Optional[Tuple[int, Callable[["Context"], str]]] = None
+
+
+class Literal(Node):
+    __slots__ = _fields = ("string",)
+
+    def __init__(self, string: str) -> None:
+        self.string = string
+
+
+class Variable(Node):
+    __slots__ = _fields = ("name",)
+
+    def __init__(self, name: str) -> None:
+        self.name = name
 
 
 Fragment = Union[Call, Literal, Variable]
 
 
-class Word(NamedTuple):
-    fragments: List[Fragment]
+class Word(Node):
+    __slots__ = _fields = ("fragments",)
+
+    def __init__(self, fragments: Iterable[Fragment]) -> None:
+        self.fragments = tuple(fragments)
 
 
 NamePattern = Union[str, Pattern[str]]
+# Commands return strings, or are coroutine functions that return strings
+CommandFunction = Callable[..., Union[str, Awaitable[str]]]
+# Estimates the number of command applications made by the scripts a
+# command runs (see pladder.script.cost). Takes a function that estimates
+# a script, and the arguments of the call (None where an argument is only
+# known at run time). The cost function of a lazy command instead takes an
+# ArgumentCost for each of its argument words, and returns the cost of the
+# ones it may evaluate.
+CostFunction = Callable[..., int]
+
+
+class ArgumentCost(NamedTuple):
+    # The argument (None if it is only known at run time) and the estimated
+    # cost of evaluating it
+    literal: Optional[str]
+    cost: int
+
+
+class Arity(NamedTuple):
+    # Positional parameters of the Python function (including the context parameter, if any)
+    parameters: Tuple[Parameter, ...]
+    min_positional: int
+    max_positional: int
+    var_positional: bool
+
+    def accepts(self, argument_count: int) -> bool:
+        if argument_count < self.min_positional:
+            return False
+        return self.var_positional or argument_count <= self.max_positional
+
+
+def arity(fn: Callable[..., Any]) -> Arity:
+    parameters = []
+    min_positional = 0
+    var_positional = False
+    for parameter in signature(fn).parameters.values():
+        if parameter.kind in [Parameter.POSITIONAL_ONLY,
+                              Parameter.POSITIONAL_OR_KEYWORD]:
+            parameters.append(parameter)
+            if parameter.default is Parameter.empty:
+                min_positional += 1
+        elif parameter.kind == Parameter.VAR_POSITIONAL:
+            parameters.append(parameter)
+            var_positional = True
+    max_positional = len(parameters) - (1 if var_positional else 0)
+    return Arity(tuple(parameters), min_positional, max_positional, var_positional)
 
 
 class CommandBinding(NamedTuple):
     name_matches: Callable[[str], bool]
     display_name: str
-    fn: Callable[..., str]
+    fn: CommandFunction
     varargs: bool
     contextual: bool
     source: str
+    arity: Arity
+    name_pattern: NamePattern
+    # Commands written in PladderScript can provide a body function. It takes
+    # the same arguments as fn, but returns the context and script that fn
+    # would interpret instead of interpreting it. This lets an evaluator run
+    # the script itself instead of recursing through fn.
+    body: Optional[Callable[..., Tuple["Context", str]]]
+    # Pure commands always give the same result for the same command name
+    # and arguments, and have no side effects. If contextual, they may only
+    # use the command name of the context.
+    pure: bool
+    # Results of memoized (pure) commands are cached, see pladder.script.memo
+    memoize: bool
+    # Lazy commands get their arguments unevaluated, as thunks (see
+    # pladder.script.interpreter.Thunk) that evaluate them when called.
+    lazy: bool
+    # Concurrent commands (typically lookups that wait for the network)
+    # have no side effects and are safe to run at the same time as each
+    # other, in any thread. Sibling calls to them may be started before the
+    # arguments to their left have been evaluated (even if evaluating those
+    # fails), so commands with side effects must not be concurrent.
+    concurrent: bool
+    # Asynchronous commands are coroutine functions. They are awaited by
+    # pladder.script.interpreter.interpret_async, and run to completion
+    # when called from synchronous evaluation.
+    asynchronous: bool
+    # Hybrid commands are asynchronous commands that only await their
+    # thunks and pladder.script.interpreter.run_script. Those only suspend
+    # under interpret_async, so synchronous evaluation runs hybrid commands
+    # directly instead of on an event loop.
+    hybrid: bool
+    # Commands that run scripts given as arguments can estimate how many
+    # command applications that makes.
+    cost: Optional[CostFunction]
 
 
 def command_binding(name_pattern: NamePattern,
-                    fn: Callable[..., str],
+                    fn: CommandFunction,
                     varargs: bool = False,
                     contextual: bool = False,
-                    source: Optional[str] = None) -> CommandBinding:
+                    source: Optional[str] = None,
+                    body: Optional[Callable[..., Tuple["Context", str]]] = None,
+                    pure: bool = False,
+                    memoize: bool = False,
+                    lazy: bool = False,
+                    concurrent: bool = False,
+                    hybrid: bool = False,
+                    cost: Optional[CostFunction] = None) -> CommandBinding:
     if isinstance(name_pattern, str):
         name: str = name_pattern
         display_name = name
@@ -69,12 +198,25 @@ def command_binding(name_pattern: NamePattern,
     else:
         raise TypeError(name_pattern)
 
+    if memoize and not pure:
+        raise ValueError("Only pure commands can be memoized")
+    if lazy and (varargs or memoize):
+        raise ValueError("Lazy commands can not be varargs or memoized")
+    if concurrent and (contextual or lazy or memoize or body is not None):
+        raise ValueError("Concurrent commands can not be contextual, lazy, memoized or have a body")
+    asynchronous = iscoroutinefunction(fn)
+    if asynchronous and (memoize or body is not None):
+        raise ValueError("Asynchronous commands can not be memoized or have a body")
+    if hybrid and not asynchronous:
+        raise ValueError("Hybrid commands must be coroutine functions")
+
     if source is None:
         source_str = "Python: " + getsource(fn).replace("\n", "")
     else:
         source_str = source
 
-    return CommandBinding(name_matches, display_name, fn, varargs, contextual, source_str)
+    return CommandBinding(name_matches, display_name, fn, varargs, contextual, source_str, arity(fn), name_pattern,
+                          body, pure, memoize, lazy, concurrent, asynchronous, hybrid, cost)
 
 
 class CommandGroup:
@@ -88,18 +230,75 @@ class CommandGroup:
 class PythonCommandGroup(CommandGroup):
     def __init__(self, initial: List[CommandBinding] = []) -> None:
         self._commands: List[CommandBinding] = list(initial)
+        self._listeners: List[Callable[[], None]] = []
+        self._reindex()
+
+    def _reindex(self) -> None:
+        # Exact names are looked up in a dict. Pattern commands are kept in
+        # registration order and are only consulted if they were registered
+        # before the exact match (the first registered binding wins).
+        self._exact: Dict[str, Tuple[int, CommandBinding]] = {}
+        self._patterns: List[Tuple[int, CommandBinding]] = []
+        self._combined_pattern: Optional[Pattern[str]] = None
+        for position, command in enumerate(self._commands):
+            self._index_command(position, command)
+
+    def _index_command(self, position: int, command: CommandBinding) -> None:
+        if isinstance(command.name_pattern, str):
+            self._exact.setdefault(command.name_pattern, (position, command))
+        else:
+            self._patterns.append((position, command))
+            self._combined_pattern = None
+
+    def _changed(self) -> None:
+        for listener in self._listeners:
+            listener()
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
 
-    def register_command(self, command_name: str, fn: Callable[..., str],
+    def register_command(self, command_name: NamePattern, fn: CommandFunction,
                          varargs: bool = False,
                          contextual: bool = False,
-                         source: Optional[str] = None) -> None:
-        self._commands.append(command_binding(command_name, fn, varargs, contextual, source))
+                         source: Optional[str] = None,
+                         pure: bool = False,
+                         memoize: bool = False,
+                         lazy: bool = False,
+                         concurrent: bool = False,
+                         hybrid: bool = False,
+                         cost: Optional[CostFunction] = None) -> None:
+        command = command_binding(command_name, fn, varargs, contextual, source, pure=pure, memoize=memoize,
+                                  lazy=lazy, concurrent=concurrent, hybrid=hybrid, cost=cost)
+        self._commands.append(command)
+        self._index_command(len(self._commands) - 1, command)
+        self._changed()
 
     def lookup_command(self, command_name: str) -> Optional[CommandBinding]:
-        for command in self._commands:
-            if command.name_matches(command_name):
-                return command
-        return None
+        position, command = self._exact.get(command_name, _NOT_FOUND)
+        if self._patterns:
+            pattern_position, pattern_command = self._match_patterns(command_name)
+            if pattern_position < position:
+                return pattern_command
+        return command
+
+    def _match_patterns(self, command_name: str) -> Tuple[int, Optional[CommandBinding]]:
+        if self._combined_pattern is None:
+            self._combined_pattern = _combine_patterns([command for _position, command in self._patterns])
+        if self._combined_pattern is _UNCOMBINABLE:
+            for position, command in self._patterns:
+                if command.name_matches(command_name):
+                    return position, command
+            return _NOT_FOUND
+        match = self._combined_pattern.match(command_name)
+        if match is None or match.lastgroup is None:
+            return _NOT_FOUND
+        return self._patterns[int(match.lastgroup[1:])]
+
+    def exact_names(self) -> List[str]:
+        return list(self._exact.keys())
+
+    def has_patterns(self) -> bool:
+        return bool(self._patterns)
 
     def list_commands(self) -> List[str]:
         return [command.display_name for command in self._commands]
@@ -109,17 +308,86 @@ class PythonCommandGroup(CommandGroup):
         if binding is None:
             raise ScriptError(f"Unknown command name: {command_name}")
         else:
-            self._commands.remove(binding)
+            self._commands = [command for command in self._commands if command is not binding]
+            self._reindex()
+            self._changed()
+
+
+_NOT_FOUND: Tuple[int, Optional[CommandBinding]] = (sys.maxsize, None)
+_generations = count(1)
+_UNCOMBINABLE = re.compile("(?!)")
+_INLINE_FLAGS = [(re.ASCII, "a"), (re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s")]
+
+
+def _combine_patterns(commands: List[CommandBinding]) -> Pattern[str]:
+    # Build a single alternation with one named group per command, so that
+    # one match finds the first registered pattern that matches. Since
+    # alternatives are tried from left to right, the first registered
+    # pattern wins, just like when they are matched one by one. Patterns
+    # with groups of their own (which could contain backreferences) or with
+    # flags that can not be scoped to a group are matched one by one.
+    alternatives = []
+    for i, command in enumerate(commands):
+        pattern = command.name_pattern
+        assert not isinstance(pattern, str)
+        flags = pattern.flags & ~re.UNICODE
+        inline_flags = ""
+        for flag, letter in _INLINE_FLAGS:
+            if flags & flag:
+                inline_flags += letter
+                flags &= ~flag
+        if pattern.groups or flags:
+            return _UNCOMBINABLE
+        alternatives.append(f"(?P<_{i}>(?{inline_flags}:{pattern.pattern}))")
+    try:
+        return re.compile("|".join(alternatives))
+    except re.error:
+        return _UNCOMBINABLE
 
 
 class CommandRegistry:
     def __init__(self, initial: Mapping[str, CommandGroup] = {}) -> None:
-        self._groups: Dict[str, CommandGroup] = dict(initial)
+        self._groups: Dict[str, CommandGroup] = {}
+        self._invalidate()
+        for group_name, group in dict(initial).items():
+            self.add_command_group(group_name, group)
+
+    def _invalidate(self) -> None:
+        self._index: Optional[Dict[str, int]] = None
+        # Generations are unique across all registries, so a cached
+        # (generation, binding) pair is never reused with another registry.
+        self.generation = next(_generations)
+
+    def commands_changed(self) -> None:
+        # Dynamic groups (e.g. aliases) call this when their commands change
+        self._invalidate()
+
+    def _build_index(self) -> Dict[str, int]:
+        # Maps each exact command name to the position of the first Python
+        # group that binds it. Groups that can not be indexed (dynamic groups
+        # and Python groups with pattern commands) are kept in _scanned and
+        # are asked in order, but only if they come before the indexed group.
+        index: Dict[str, int] = {}
+        self._scanned: List[Tuple[int, CommandGroup]] = []
+        self._ordered_groups: List[CommandGroup] = list(self._groups.values())
+        for position, group in enumerate(self._ordered_groups):
+            if isinstance(group, PythonCommandGroup):
+                for command_name in group.exact_names():
+                    index.setdefault(command_name, position)
+                if group.has_patterns():
+                    self._scanned.append((position, group))
+            else:
+                self._scanned.append((position, group))
+        self._index = index
+        return index
 
     def add_command_group(self, group_name: str, group: CommandGroup) -> None:
         if group_name in self._groups:
             raise ScriptError(f"Group {group_name} already registered")
         self._groups[group_name] = group
+        if isinstance(group, PythonCommandGroup):
+            group.add_listener(self._invalidate)
+        self._invalidate()
 
     def new_command_group(self, group_name: str) -> PythonCommandGroup:
         group = PythonCommandGroup()
@@ -127,17 +395,22 @@ class CommandRegistry:
         return group
 
     def lookup_command(self, command_name: str) -> Optional[CommandBinding]:
-        for group in self._groups.values():
+        index = self._index
+        if index is None:
+            index = self._build_index()
+        position = index.get(command_name, len(self._ordered_groups))
+        for scanned_position, group in self._scanned:
+            if scanned_position >= position:
+                break
             command = group.lookup_command(command_name)
             if command is not None:
                 return command
+        if position < len(self._ordered_groups):
+            return self._ordered_groups[position].lookup_command(command_name)
         return None
 
     def lookup_group(self, group_name: str) -> Optional[CommandGroup]:
-        for candidate_group_name, candidate_group in self._groups.items():
-            if candidate_group_name == group_name:
-                return candidate_group
-        return None
+        return self._groups.get(group_name)
 
     def list_commands(self) -> List[str]:
         return [command_name
@@ -148,12 +421,73 @@ class CommandRegistry:
         return list(self._groups.keys())
 
 
-Environment = Dict[str, str]
+class CallSite:
+    # An inline cache of the command a call site was resolved to. It is
+    # reused as long as the call site has the same command name and the
+    # registry is of the same generation (generations are unique across
+    # registries). The entry is replaced in one assignment, so a call site
+    # may be shared between threads.
+    __slots__ = ["_entry"]
+
+    def __init__(self) -> None:
+        self._entry: Tuple[int, str, Optional[CommandBinding]] = (0, "", None)
+
+    def lookup(self, commands: CommandRegistry, command_name: str) -> Optional[CommandBinding]:
+        generation, cached_name, command = self._entry
+        if generation != commands.generation or cached_name != command_name:
+            command = commands.lookup_command(command_name)
+            self._entry = (commands.generation, command_name, command)
+        return command
+
+
+Environment = Mapping[str, str]
 Metadata = Dict[Any, str]
 Result = str
 Char = str
 
 
+class Scope(Mapping[str, str]):
+    # A persistent environment: a small frame of local bindings on top of a
+    # parent environment, which is shared instead of copied. Lookups walk
+    # the chain, so chains longer than MAX_DEPTH are flattened into one frame.
+    MAX_DEPTH = 8
+
+    __slots__ = ["_bindings", "_parent", "_depth"]
+
+    def __init__(self, bindings: Dict[str, str], parent: Environment = {}) -> None:
+        if isinstance(parent, Scope) and parent._depth >= self.MAX_DEPTH:
+            parent = parent._flatten()
+        self._bindings = bindings
+        self._parent = parent
+        self._depth: int = parent._depth + 1 if isinstance(parent, Scope) else 1
+
+    def __getitem__(self, name: str) -> str:
+        scope: Environment = self
+        while isinstance(scope, Scope):
+            bindings = scope._bindings
+            if name in bindings:
+                return bindings[name]
+            scope = scope._parent
+        return scope[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._flatten())
+
+    def __len__(self) -> int:
+        return len(self._flatten())
+
+    def _flatten(self) -> Dict[str, str]:
+        if isinstance(self._parent, Scope):
+            result = self._parent._flatten()
+        else:
+            result = dict(self._parent)
+        result.update(self._bindings)
+        return result
+
+    def __repr__(self) -> str:
+        return f"Scope({self._flatten()!r})"
+
+
 class TraceEntry(NamedTuple):
     command: CommandBinding
     command_name: str
@@ -163,19 +497,174 @@ class TraceEntry(NamedTuple):
     result: Union[None, str, Exception]
 
 
+class Trace(List[TraceEntry]):
+    # A full trace: every command application is recorded, and each entry
+    # gets a subtrace of its own for the applications it made.
+    enabled = True
+    truncated = False
+
+    def subtrace(self) -> "Trace":
+        return Trace()
+
+
+class NoTrace(Trace):
+    # Tracing turned off: nothing is recorded.
+    enabled = False
+
+    def append(self, entry: TraceEntry) -> None:
+        pass
+
+    def subtrace(self) -> "Trace":
+        return self
+
+
+class BoundedTrace(Trace):
+    # Only keeps the last max_entries entries of each (sub)trace, and drops
+    # the entries nested deeper than max_depth. The root trace is marked as
+    # truncated if anything was dropped.
+
+    def __init__(self, max_entries: int = 16, max_depth: int = 3,
+                 depth: int = 0, root: Optional["BoundedTrace"] = None) -> None:
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_depth = max_depth
+        self.depth = depth
+        if root is None:
+            self.root = self
+            self.too_deep: Trace = _TooDeepTrace(self)
+        else:
+            self.root = root
+            self.too_deep = root.too_deep
+
+    def append(self, entry: TraceEntry) -> None:
+        super().append(entry)
+        if len(self) > self.max_entries:
+            del self[0]
+            self.root.truncated = True
+
+    def subtrace(self) -> Trace:
+        if self.depth + 1 >= self.max_depth:
+            return self.too_deep
+        return BoundedTrace(self.max_entries, self.max_depth, self.depth + 1, self.root)
+
+
+class _TooDeepTrace(NoTrace):
+    # Still enabled, so that appending marks the root as truncated
+    enabled = True
+
+    def __init__(self, root: BoundedTrace) -> None:
+        super().__init__()
+        self.root = root
+
+    def append(self, entry: TraceEntry) -> None:
+        self.root.truncated = True
+
+
+class BudgetExceeded(ScriptError):
+    pass
+
+
+class BudgetLimits(NamedTuple):
+    max_applications: int = 100000
+    max_seconds: float = 10.0
+    max_string_length: int = 1000000
+
+
+class Budget:
+    # Limits how much work a script may do before it is aborted. A budget is
+    # shared by all contexts derived from the one it was created for, so the
+    # limits apply to the whole request.
+
+    def __init__(self, limits: BudgetLimits = BudgetLimits()) -> None:
+        self.limits = limits
+        self.applications = 0
+        self.deadline = time.monotonic() + limits.max_seconds
+
+    def charge(self) -> None:
+        self.applications += 1
+        if self.applications > self.limits.max_applications:
+            raise BudgetExceeded(f"Script aborted after {self.limits.max_applications} command applications")
+        if time.monotonic() > self.deadline:
+            raise BudgetExceeded(f"Script aborted after running for {self.limits.max_seconds} seconds")
+
+    def check_string(self, string: str) -> None:
+        self.check_length(len(string))
+
+    def check_length(self, length: int) -> None:
+        if length > self.limits.max_string_length:
+            raise BudgetExceeded(f"Script aborted: result longer than {self.limits.max_string_length} characters")
+
+
+class ProfileEntry:
+    __slots__ = ["calls", "total_ns", "self_ns"]
+
+    def __init__(self) -> None:
+        self.calls = 0
+        # Time spent in the command, including the commands it applied.
+        # Recursive applications are only counted once.
+        self.total_ns = 0
+        # Time spent in the command itself
+        self.self_ns = 0
+
+
+class Profile:
+    # Records how many times each command name was applied and how much time
+    # was spent in it. Like a budget, a profile is shared by all contexts
+    # derived from the one it was created for. Applications must be started
+    # and stopped in nesting order, so calls are not run concurrently while
+    # they are profiled.
+
+    def __init__(self, clock: Callable[[], int] = time.perf_counter_ns) -> None:
+        self.clock = clock
+        self.entries: Dict[str, ProfileEntry] = {}
+        # For each running application: when it started, and the time spent
+        # in the commands it applied
+        self._running: List[List[int]] = []
+        self._running_names: Dict[str, int] = {}
+
+    def start(self, command_name: str) -> None:
+        self._running_names[command_name] = self._running_names.get(command_name, 0) + 1
+        self._running.append([self.clock(), 0])
+
+    def stop(self, command_name: str) -> None:
+        start, callees_ns = self._running.pop()
+        elapsed = self.clock() - start
+        entry = self.entries.get(command_name)
+        if entry is None:
+            entry = self.entries[command_name] = ProfileEntry()
+        entry.calls += 1
+        entry.self_ns += elapsed - callees_ns
+        running = self._running_names[command_name] - 1
+        self._running_names[command_name] = running
+        if running == 0:
+            entry.total_ns += elapsed
+        if self._running:
+            self._running[-1][1] += elapsed
+
+
 class Context(NamedTuple):
     commands: CommandRegistry
     environment: Environment
     metadata: Metadata
     command_name: str
-    trace: List[TraceEntry]
+    trace: Trace
+    budget: Optional[Budget] = None
+    profile: Optional[Profile] = None
+    # Whether scripts run by hybrid commands (see CommandBinding) are
+    # evaluated by interpret_async
+    asynchronous: bool = False
 
 
 def new_context(commands: CommandRegistry, *,
                 environment: Environment = {},
                 metadata: Metadata = {},
-                command_name: str = "<TOP>") -> Context:
-    return Context(commands, environment, metadata, command_name, [])
+                command_name: str = "<TOP>",
+                budget: Optional[Budget] = None,
+                trace: Optional[Trace] = None,
+                profile: Optional[Profile] = None) -> Context:
+    if trace is None:
+        trace = Trace()
+    return Context(commands, environment, metadata, command_name, trace, budget, profile)
 
 
 class ApplyError(ScriptError):
@@ -0,0 +1,115 @@
+"""Structured values passed between commands.
+
+A list is words separated by spaces, where words that need it are quoted
+in braces the same way `escape` quotes the words of a script. Words with
+braces that do not match (like the smiley `:{`) can not be quoted in
+braces, and are instead written with a backslash before each brace,
+space and backslash. Other backslashes are taken literally. Commands that
+make lists return a ListValue, which is the rendered string with the
+items attached. Commands that take lists read the items from it without
+parsing the string again.
+
+The coercion rule: a ListValue is a `str` and is equal to its rendering,
+so commands that take strings work on it unchanged, and anything that
+makes a new string from it (concatenation in a word, slicing, `str()`)
+gets the rendering only. A plain string given to a command that takes a
+list is parsed as a list.
+"""
+
+import re
+from typing import Iterable, List, Tuple
+
+from .types import ScriptError
+
+
+class ListValue(str):
+    # The items, which are never evaluated. Always the same as parsing the
+    # string with parse_list.
+    items: Tuple[str, ...]
+
+
+def make_list(items: Iterable[str]) -> ListValue:
+    items = tuple(items)
+    value = ListValue(" ".join(map(quote_item, items)))
+    value.items = items
+    return value
+
+
+def list_items(value: str) -> Tuple[str, ...]:
+    if isinstance(value, ListValue):
+        return value.items
+    return parse_list(value)
+
+
+_BACKSLASHED = re.compile(r"[ {}\\]")
+_LIST_BRACE = re.compile(r"[{}]")
+
+
+def quote_item(item: str) -> str:
+    if item and " " not in item and "{" not in item and "}" not in item and "$" not in item and "\\" not in item:
+        return item
+    elif ("{" in item or "}" in item) and not _balanced(item):
+        return _BACKSLASHED.sub(r"\\\g<0>", item)
+    return "{" + item + "}"
+
+
+def _balanced(item: str) -> bool:
+    level = 0
+    for match in _LIST_BRACE.finditer(item):
+        level += 1 if match.group() == "{" else -1
+        if level < 0:
+            return False
+    return level == 0
+
+
+def parse_list(text: str) -> Tuple[str, ...]:
+    if "{" not in text and "\\" not in text:
+        return tuple(item for item in text.split(" ") if item)
+    items = []
+    pos = 0
+    end = len(text)
+    while pos < end:
+        if text[pos] == " ":
+            pos += 1
+        elif text[pos] == "{":
+            level = 1
+            scan = pos + 1
+            while level:
+                match = _LIST_BRACE.search(text, scan)
+                if match is None:
+                    raise ScriptError("Missing closing brace in list")
+                scan = match.end()
+                level += 1 if match.group() == "{" else -1
+            items.append(text[pos + 1:scan - 1])
+            pos = scan
+        else:
+            item, pos = _parse_bare_item(text, pos)
+            items.append(item)
+    return tuple(items)
+
+
+_BARE_SPECIAL = re.compile(r"[ \\]")
+_ESCAPED = frozenset(" {}\\")
+
+
+def _parse_bare_item(text: str, pos: int) -> Tuple[str, int]:
+    # Reads a word up to the next space. A backslash before a character
+    # that quote_item escapes makes that character part of the word. Other
+    # backslashes (like in the smiley \o/) are kept as they are.
+    parts: List[str] = []
+    while True:
+        match = _BARE_SPECIAL.search(text, pos)
+        if match is None:
+            parts.append(text[pos:])
+            return "".join(parts), len(text)
+        special = match.start()
+        if text[special] == " ":
+            parts.append(text[pos:special])
+            return "".join(parts), special
+        escaped = text[special + 1:special + 2]
+        if escaped and escaped in _ESCAPED:
+            parts.append(text[pos:special])
+            parts.append(escaped)
+        else:
+            parts.append(text[pos:special + 1 + len(escaped)])
+        pos = special + 1 + len(escaped)
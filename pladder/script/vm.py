@@ -0,0 +1,245 @@
+"""An alternative evaluator that runs PladderScript on an explicit stack.
+
+Scripts are compiled to a flat list of instructions. Nested calls are
+evaluated by the same loop, and commands that provide a `body` (aliases
+and userdefs) get a new frame on the frame stack instead of a new level
+of Python recursion. The nesting depth is therefore limited by
+`max_depth` rather than by `sys.getrecursionlimit()`. A body command
+called last in the script of another one replaces its frame, so tail
+calls do not count towards the depth.
+"""
+
+from typing import Any, List, Optional, Tuple, Union
+
+from .cache import LruCache
+from .interpreter import LazyWords, apply_call, bind_arguments, compile, invoke_lazy
+from .types import Call, CallSite, CommandBinding, Context, EvalError, Fragment, Literal, Result, TraceEntry, Word
+
+
+DEFAULT_MAX_DEPTH = 10000
+PROGRAM_CACHE_SIZE = 1024
+
+# Opcodes
+PUSH = 0    # arg: string to push
+LOAD = 1    # arg: name of variable to push
+CONCAT = 2  # arg: number of strings to pop and push joined
+# arg: (number of words to pop (command name and arguments), call site)
+APPLY = 3
+RETURN = 4  # arg: unused
+# arg: (lazy words, number of instructions to skip, call site). If the command
+# name on the stack names a lazy command, apply it to thunks of the argument
+# words and skip the instructions that would evaluate them.
+LAZY = 5
+
+Instruction = Tuple[int, Any]
+Program = List[Instruction]
+
+_program_cache: LruCache[str, Program] = LruCache(PROGRAM_CACHE_SIZE)
+
+
+def compile_program(call: Call) -> Program:
+    program: Program = []
+    _emit_call(program, call)
+    program.append((RETURN, None))
+    return program
+
+
+def _emit_call(program: Program, call: Call) -> None:
+    if not call.words:
+        program.append((PUSH, ""))
+        return
+    _emit_word(program, call.words[0])
+    site = CallSite()
+    arguments: Program = []
+    for word in call.words[1:]:
+        _emit_word(arguments, word)
+    arguments.append((APPLY, (len(call.words), site)))
+    # Arguments that are all literals are passed to lazy commands as thunks
+    # by APPLY, so only calls with other arguments need a LAZY instruction.
+    if not all(_is_literal(word) for word in call.words[1:]):
+        lazy_words: LazyWords = [(word, _WordProgram(word)) for word in call.words[1:]]
+        program.append((LAZY, (lazy_words, len(arguments), site)))
+    program.extend(arguments)
+
+
+def _is_literal(word: Word) -> bool:
+    return all(isinstance(fragment, Literal) for fragment in word.fragments)
+
+
+def _emit_word(program: Program, word: Word) -> None:
+    fragments: List[Fragment] = []
+    for fragment in word.fragments:
+        if isinstance(fragment, Literal) and fragments and isinstance(fragments[-1], Literal):
+            fragments[-1] = Literal(fragments[-1].string + fragment.string)
+        else:
+            fragments.append(fragment)
+    if not fragments:
+        program.append((PUSH, ""))
+        return
+    for fragment in fragments:
+        if isinstance(fragment, Literal):
+            program.append((PUSH, fragment.string))
+        elif isinstance(fragment, Call):
+            _emit_call(program, fragment)
+        else:
+            program.append((LOAD, fragment.name))
+    if len(fragments) > 1:
+        program.append((CONCAT, len(fragments)))
+
+
+class _WordProgram:
+    # Evaluates a word (the argument of a lazy command) on its own stack. The
+    # program is compiled the first time it is needed.
+    __slots__ = ["word", "program"]
+
+    def __init__(self, word: Word) -> None:
+        self.word = word
+        self.program: Optional[Program] = None
+
+    def __call__(self, context: Context) -> str:
+        if self.program is None:
+            self.program = []
+            _emit_word(self.program, self.word)
+            self.program.append((RETURN, None))
+        return run_program(context, self.program)
+
+
+def _program_for_script(script: str) -> Program:
+    program = _program_cache.get(script)
+    if program is None:
+        program = compile_program(compile(script))
+        _program_cache.put(script, program)
+    return program
+
+
+class _Frame:
+    __slots__ = ["program", "pc", "context", "command", "command_name", "arguments", "caller_trace", "tail_of"]
+
+    def __init__(self,
+                 program: Program,
+                 context: Context,
+                 command: Optional[CommandBinding] = None,
+                 command_name: str = "",
+                 arguments: List[str] = [],
+                 caller_trace: List[TraceEntry] = []) -> None:
+        self.program = program
+        self.pc = 0
+        self.context = context
+        self.command = command
+        self.command_name = command_name
+        self.arguments = arguments
+        self.caller_trace = caller_trace
+        # The frame this one replaced, by being called in tail position
+        self.tail_of: Optional[_Frame] = None
+
+    def finish(self, result: Union[str, Exception]) -> None:
+        # Also finishes the frames this one replaced, with the same result
+        frame: Optional[_Frame] = self
+        while frame is not None:
+            assert frame.command is not None, "The top frame has no caller"
+            if frame.context.profile is not None:
+                frame.context.profile.stop(frame.command_name)
+            frame.caller_trace.append(TraceEntry(frame.command, frame.command_name, frame.arguments,
+                                                 frame.context.trace, result))
+            frame = frame.tail_of
+
+
+def run(context: Context, script: str, max_depth: int = DEFAULT_MAX_DEPTH) -> Result:
+    return run_program(context, _program_for_script(script), max_depth)
+
+
+def run_call(context: Context, call: Call, max_depth: int = DEFAULT_MAX_DEPTH) -> Result:
+    return run_program(context, compile_program(call), max_depth)
+
+
+def run_program(context: Context, program: Program, max_depth: int = DEFAULT_MAX_DEPTH) -> Result:
+    frames = [_Frame(program, context)]
+    stack: List[str] = []
+    push = stack.append
+    # The current frame's program counter is kept in a local variable and
+    # is only written back to the frame when another frame is entered.
+    frame = frames[0]
+    pc = 0
+    try:
+        while True:
+            op, arg = program[pc]
+            pc += 1
+            if op == PUSH:
+                push(arg)
+            elif op == LOAD:
+                try:
+                    push(context.environment[arg])
+                except KeyError:
+                    raise EvalError(f"Unbound variable: {arg}")
+            elif op == APPLY:
+                count, site = arg
+                words = stack[-count:]
+                del stack[-count:]
+                result = _apply(context, site, words[0], words[1:])
+                if isinstance(result, _Frame):
+                    if program[pc][0] == RETURN and len(frames) > 1:
+                        # A tail call: nothing is left to do in the current frame
+                        result.tail_of = frame
+                        frames[-1] = result
+                    else:
+                        frame.pc = pc
+                        frames.append(result)
+                        if len(frames) > max_depth:
+                            raise EvalError("Maximum nesting depth exceeded")
+                    frame = result
+                    program, pc, context = frame.program, 0, frame.context
+                else:
+                    push(result)
+            elif op == CONCAT:
+                joined = "".join(stack[-arg:])
+                del stack[-arg:]
+                push(joined)
+            elif op == LAZY:
+                lazy_words, skip, site = arg
+                command = site.lookup(context.commands, stack[-1])
+                if command is not None and command.lazy:
+                    push(invoke_lazy(context, command, stack.pop(), lazy_words))
+                    pc += skip
+            elif op == RETURN:
+                frames.pop()
+                if not frames:
+                    return stack.pop()
+                frame.finish(stack[-1])
+                frame = frames[-1]
+                program, pc, context = frame.program, frame.pc, frame.context
+            else:
+                raise Exception(f"Unknown opcode: {op}")
+    except Exception as e:
+        # Record the failure in the trace of every command that was running
+        while len(frames) > 1:
+            frames.pop().finish(e)
+        raise
+
+
+def _apply(context: Context, site: CallSite, command_name: str, arguments: List[str]) -> Union[_Frame, str]:
+    command = site.lookup(context.commands, command_name)
+    if command is None:
+        raise EvalError(f"Unknown command name: {command_name}")
+    subtrace = context.trace.subtrace()
+    if command.contextual:
+        command_context = context._replace(command_name=command_name, trace=subtrace)
+    else:
+        command_context = context
+    try:
+        if command.body is None:
+            result = apply_call(command_context, command, command_name, arguments)
+        else:
+            if context.budget is not None:
+                context.budget.charge()
+            fn_arguments = bind_arguments(command_context, command, command_name, arguments)
+            body_context, script = command.body(*fn_arguments)
+            frame = _Frame(_program_for_script(script), body_context,
+                           command, command_name, arguments, context.trace)
+            if body_context.profile is not None:
+                body_context.profile.start(command_name)
+            return frame
+    except Exception as e:
+        context.trace.append(TraceEntry(command, command_name, arguments, subtrace, e))
+        raise
+    context.trace.append(TraceEntry(command, command_name, arguments, subtrace, result))
+    return result